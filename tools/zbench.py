@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# zbench.py
+# 	benchmarks for the zettel-compose.py hot path
+#
+# Usage: tools/zbench.py [--update] [--tolerance=0.25] [--repeat=5] [--baseline=file]
+#
+# Every benchmark runs over a fixture archive generated from a fixed seed.
+# Timings (best of --repeat runs) and output digests are checked against the
+# baseline file; the script exits with status 1 on a slowdown beyond the
+# tolerance or on changed output. Use --update to record a new baseline.
+
+import os, sys, io, getopt, json, time, random, hashlib, tempfile, shutil
+import importlib.util
+from contextlib import redirect_stdout
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPOSER = os.path.join(TOOLS_DIR, '..', 'zettel-compose.py')
+BASELINE = os.path.join(TOOLS_DIR, 'zbench-baseline.json')
+
+FIXTURE_SEED = 2022
+FIXTURE_NOTES = 120
+LOOKUP_ARCHIVES = [ 1000, 20000 ]	# notes in the archives for lookup benchmarks
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+	"tempor incididunt ut labore et dolore magna aliqua *emphasis* **strong**").split()
+
+# option combinations for the parse_index benchmarks
+COMBINATIONS = [
+	('default', []),
+	('handout', ['-h-']),
+	('handout-sections', ['-h+']),
+	('handout-latex', ['-h+', '-P']),
+	('latex', ['-P']),
+	('link-all', ['-L']),
+	('only-index', ['-I']),
+	('extract', ['-X']),
+	('book', ['-S', '-I', '-n', '--no-separator']),
+]
+
+def load_composer():
+	spec = importlib.util.spec_from_file_location('zettel_compose', COMPOSER)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def make_fixture(directory):
+	"""
+	Write a fixture archive, always the same for a given seed; returns the
+	index note's path
+	"""
+	rnd = random.Random(FIXTURE_SEED)
+
+	def prose(n):
+		return ' '.join(rnd.choice(WORDS) for _ in range(n))
+
+	def write(name, text):
+		with open(os.path.join(directory, name), 'w') as f:
+			f.write(text)
+
+	body, quote, seq, source = 10000, 20000, 30000, 40000
+	index = [ '---', 'title: "Fixture"', '...', '' ]
+	for i in range(FIXTURE_NOTES):
+		if i % 20 == 0:
+			index.append('\n# Part %d\n' % (i // 20))
+		index.append('§ [[%d]]' % (body + i))
+	index.append('[[%d]]: hidden' % body)
+	write('1000 Index.md', '\n'.join(index) + '\n')
+
+	for i in range(FIXTURE_NOTES):
+		lines = [ '---', 'title: "Note %d"' % i, 'tags: #fixture', '...', '' ]
+		if i % 20 == 0:
+			lines = lines + [ '# Chapter %d' % (i // 20), '' ]
+		for p in range(6):
+			lines.append(prose(45) + ' § [[%d]] and [[%d]] @ [[%d]][^n%d].' %
+				(body + rnd.randrange(FIXTURE_NOTES), body + rnd.randrange(FIXTURE_NOTES), source + rnd.randrange(20), p))
+			lines.append('')
+		lines.append('△ ' + prose(10))
+		if i % 3 == 0:
+			lines = lines + [ '> [[%d]]' % (quote + rnd.randrange(60)), '' ]
+		if i % 5 == 0:
+			lines = lines + [ '+ [[%d]]' % (seq + i), '' ]
+			write('%d Sequential %d.md' % (seq + i, i), prose(60) + ' -@ [[%d]].\n' % (source + i % 20))
+		if i % 9 == 0:
+			lines = lines + [ '> [[%d]] :: [[%d]]' % (quote + 100 + i, quote + 200 + i), '' ]
+			write('%d Left %d.md' % (quote + 100 + i, i), '---\ntitle: "L%d"\n...\n' % i + prose(50) + '\n')
+			write('%d Right %d.md' % (quote + 200 + i, i), '---\ntitle: "R%d"\n...\n' % i + prose(50) + '\n')
+		lines = lines + [ '[^n%d]: %s' % (p, prose(12)) for p in range(6) ]
+		write('%d Note %d.md' % (body + i, i), '\n'.join(lines) + '\n')
+
+	for q in range(60):
+		write('%d Quote %d.md' % (quote + q, q), '---\ntitle: "Q%d"\n...\n' % q +
+			'\n'.join('> ' + prose(30) for _ in range(4)) + '\n> see § [[%d]]\n' % (body + q))
+	for c in range(20):
+		write('%d Source %d.md' % (source + c, c), '---\ntitle: "S%d"\ncitekey: Key%d\nloc: %d\n...\nbody\n' % (c, c, c))
+
+	return os.path.join(directory, '1000 Index.md')
+
+def make_sharded_archive(directory, size):
+	"""
+	Empty notes in subdirectories by id prefix; returns an index pathname
+	"""
+	for i in range(size):
+		zettel_id = str(100000 + i)
+		shard = os.path.join(directory, zettel_id[:4])
+		if not os.path.isdir(shard):
+			os.mkdir(shard)
+		open(os.path.join(shard, zettel_id + ' Note.md'), 'w').close()
+	return os.path.join(directory, '1000 Index.md')
+
+def make_stub_pandoc(directory):
+	"""
+	A stand-in for pandoc, so that -P measures our own work only
+	"""
+	pathname = os.path.join(directory, 'pandoc')
+	with open(pathname, 'w') as f:
+		f.write('#!' + sys.executable + '\nimport sys\nsys.stdout.write(sys.stdin.read())\n')
+	os.chmod(pathname, 0o755)
+	return pathname
+
+class Bench(object):
+	def __init__(self, zc, index):
+		self.zc = zc
+		self.index = index
+		self.defaults = dict(zc.options)
+
+	def setup(self, args):
+		zc = self.zc
+		zc.options.clear()
+		zc.options.update(self.defaults)
+		zc.output_digests.clear()
+		zc.note_cache.clear()
+		zc.parse_options(args)
+		zc._initialize_stack()
+		zc.index_filename = self.index
+		zc.zettel_dir = os.path.dirname(self.index)
+
+	def compose(self, args):
+		self.setup(args)
+		out = io.StringIO()
+		with redirect_stdout(out):
+			self.zc.parse_index(self.index)
+		return out.getvalue()
+
+	def fixture_lines(self):
+		lines = []
+		for pathname in sorted(os.listdir(os.path.dirname(self.index))):
+			with open(os.path.join(os.path.dirname(self.index), pathname)) as f:
+				lines = lines + f.read().splitlines()
+		return lines
+
+	def parse_line(self):
+		lines = self.fixture_lines()
+		def run():
+			result = []
+			for line in lines:
+				key, match, end = self.zc._parse_line(line, self.zc.rx_dict)
+				result.append(key)
+			return ' '.join(str(k) for k in result)
+		return run
+
+	def tokenize_line(self):
+		"""
+		The tokens of every line, as notes are tokenized when read
+		"""
+		lines = self.fixture_lines()
+		def run():
+			return '\n'.join(repr(self.zc._tokenize_line(line)) for line in lines)
+		return run
+
+	def parse_zettel(self):
+		self.setup([])
+		self.zc._z_set_index(self.index)
+		self.zc.LinkWalk().walk(self.zc.z_stack)	# fix the numbering first
+		notes = [ zn for zn in self.zc.z_stack if self.zc.z_map[zn].type == self.zc.NT_BODY ]
+		def run():
+			out = io.StringIO()
+			with redirect_stdout(out):
+				return '\n'.join('\n'.join(self.zc.parse_zettel(self.zc.z_map[zn], zn)) for zn in notes)
+		return run
+
+	def lookup(self, directory, size):
+		"""
+		Note lookups in a sharded archive, once its id index is built
+		"""
+		index = make_sharded_archive(directory, size)
+		rnd = random.Random(FIXTURE_SEED)
+		zettel_ids = [ str(100000 + rnd.randrange(size)) for i in range(2000) ]
+		self.setup([ '-R' ])
+		self.zc.index_filename = index
+		self.zc._z_build_index()
+		def run():
+			return ' '.join(os.path.basename(self.zc._z_get_filepath(zn)[0]) for zn in zettel_ids)
+		return run
+
+MIN_SAMPLE_TIME = 0.2
+
+def measure(run, repeat):
+	"""
+	Best time per run out of `repeat` samples, and a digest of the result.
+	Fast benchmarks are run several times in each sample, as timeit does
+	"""
+	start = time.perf_counter()
+	result = run()
+	loops = max(1, int(MIN_SAMPLE_TIME / (time.perf_counter() - start)))
+	timings = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		for j in range(loops):
+			run()
+		timings.append((time.perf_counter() - start) / loops)
+	return min(timings), hashlib.md5(result.encode('utf-8')).hexdigest()
+
+def main(argv):
+	useroptions, args = getopt.getopt(argv, 'u', [ 'update', 'tolerance=', 'repeat=', 'baseline=' ])
+	update, tolerance, repeat, baseline_file = False, 0.25, 5, BASELINE
+	for opt, arg in useroptions:
+		if opt in ('-u', '--update'):
+			update = True
+		elif opt == '--tolerance':
+			tolerance = float(arg)
+		elif opt == '--repeat':
+			repeat = int(arg)
+		elif opt == '--baseline':
+			baseline_file = arg
+
+	workdir = tempfile.mkdtemp(prefix='zbench-')
+	try:
+		archive = os.path.join(workdir, 'archive')
+		os.mkdir(archive)
+		index = make_fixture(archive)
+		zc = load_composer()
+		zc.CF_PANDOC = make_stub_pandoc(workdir)
+		bench = Bench(zc, index)
+
+		# each benchmark is set up right before it runs
+		benchmarks = [ ('_parse_line', bench.parse_line), ('_tokenize_line', bench.tokenize_line),
+			('parse_zettel', bench.parse_zettel) ]
+		for name, args in COMBINATIONS:
+			benchmarks.append(('parse_index ' + name, (lambda args: lambda: lambda: bench.compose(args))(args)))
+		for size in LOOKUP_ARCHIVES:
+			os.mkdir(os.path.join(workdir, str(size)))
+			benchmarks.append(('_z_get_filepath %d notes' % size, (lambda size: lambda: bench.lookup(os.path.join(workdir, str(size)), size))(size)))
+
+		results = {}
+		for name, setup in benchmarks:
+			results[name] = measure(setup(), repeat)
+	finally:
+		shutil.rmtree(workdir)
+
+	if update or not os.path.exists(baseline_file):
+		with open(baseline_file, 'w') as f:
+			json.dump(dict((name, { 'seconds': t, 'digest': d }) for name, (t, d) in results.items()), f, indent=1, sort_keys=True)
+			f.write('\n')
+		for name, (t, d) in results.items():
+			print('%-30s %9.2f ms' % (name, t * 1000))
+		print('Baseline written to ' + baseline_file)
+		return 0
+
+	with open(baseline_file) as f:
+		baseline = json.load(f)
+
+	failed = False
+	for name, (t, d) in results.items():
+		status = ''
+		if name not in baseline:
+			status = 'new'
+		else:
+			base = baseline[name]
+			change = (t - base['seconds']) / base['seconds']
+			status = '%+6.1f%%' % (change * 100)
+			if change > tolerance:
+				status = status + '  REGRESSION'
+				failed = True
+			if d != base['digest']:
+				status = status + '  OUTPUT CHANGED'
+				failed = True
+		print('%-30s %9.2f ms  %s' % (name, t * 1000, status))
+
+	return 1 if failed else 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# zlatex.py
+# 	checks the built-in Markdown to LaTeX conversion of zettel-compose.py
+# 	against pandoc
+#
+# Usage: tools/zlatex.py [--pandoc=pandoc] [--random=2000] [note files...]
+#
+# Every text of the corpus below, of a set of random paragraphs generated
+# from a fixed seed, and of the notes given (without their frontmatter), is
+# converted by _md_to_latex and, if it is converted at all, compared with
+# pandoc's output. Exits with status 1 if any output differs.
+
+import os, sys, getopt, random, subprocess
+import importlib.util
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPOSER = os.path.join(TOOLS_DIR, '..', 'zettel-compose.py')
+
+SEED = 2022
+
+CORPUS = [
+	'Texto à esquerda *ênfase*.',
+	'Right text **strong**.',
+	'A paragraph[^fn-1-a] with a footnote.\n\n[^fn-1-a]: The note, with *emphasis*.',
+	'Short[^n] x.\n\n[^n]: a note that is rather long and goes on and on and on so that it needs to wrap beyond seventy two columns for sure.',
+	'First paragraph.\n\nSecond paragraph,\nover two lines.',
+	'Mr. Smith, cf. p. 12 (p. 13), e.g. this; Mr.\nJones.',
+	'l\'homme, students\' x, 50% & #1 -- dash --- rule … ellipsis... end',
+	'a*b*c*d* and *a*b*c* and caf*é*, **a** and **b**, *a **b** c*, **a *b* c**',
+	'*ênfase\nacross lines*',
+	'“Curly” quotes ‘single’ and l’apostrophe « guillemets » § 3 ° x\xa0y',
+	'averyveryveryveryveryveryveryveryveryveryveryveryveryveryveryveryveryverylongword and more',
+	'Ends with an ellipsis…',
+	'*a…* a… *b* …1 a…§',
+	'中文 text with wide characters 中文中文中文中文中文中文中文中文中文中文中文中文中文 that wraps',
+	'Combining: ééé ' * 8,
+	'“the ‘idea’ is ‘new’”, ‘“nested” first’, l’‘x’ and “a’”',
+	'Trailing space. ',
+	'The end.[^fn] \n\n[^fn]: note',
+	'Ends a line \nand the paragraph ',
+	'a --- b ---- c -- d, a—b–c',
+	'100 % sure and\n% not a title',
+	'',
+	'[^1]: a note for nothing',
+	# not converted, for pandoc
+	'# A heading',
+	'> a quote',
+	'- a list',
+	'1. a list',
+	'a. a list',
+	'Text with [a link](http://example.com).',
+	'Text with `code` and $math$.',
+	'"ASCII quotes" and \'single\'.',
+	'Hard break  \nhere.',
+	'A reference[^missing].',
+	'% A title block',
+	'a -— b, a -– b, a —— b',
+]
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut "
+	"labore et dolore magna aliqua Texto à esquerda ênfase façon l'homme 50% #1 & -- — – … ... "
+	"Mr. p. cf. e.g. i.e. vol. etc. § « » (x) x, x; x: x! x? x.").split()
+
+def random_text(rnd):
+	"""
+	Paragraphs of words, some emphasized, with a footnote now and then
+	"""
+	paragraphs, notes = [], []
+	for p in range(rnd.randint(1, 3)):
+		lines = []
+		for l in range(rnd.randint(1, 4)):
+			words = []
+			for w in range(rnd.randint(1, 16)):
+				word = rnd.choice(WORDS)
+				style = rnd.random()
+				if style < 0.06:
+					word = '*' + word + '*'
+				elif style < 0.09:
+					word = '**' + word + '**'
+				elif style < 0.11:
+					notes.append('[^fn-%d]: ' % len(notes) + ' '.join(rnd.choice(WORDS) for i in range(rnd.randint(1, 20))))
+					word = word + '[^fn-%d]' % (len(notes) - 1)
+				words.append(word)
+			lines.append(' '.join(words))
+		paragraphs.append('\n'.join(lines))
+	return '\n\n'.join(paragraphs + notes)
+
+def note_text(pathname):
+	with open(pathname) as f:
+		lines = f.read().splitlines()
+	if lines and lines[0] == '---':
+		for i, line in enumerate(lines[1:]):
+			if line in ('---', '...'):
+				lines = lines[i + 2:]
+				break
+	return '\n'.join(lines)
+
+def main(argv):
+	useroptions, args = getopt.getopt(argv, '', [ 'pandoc=', 'random=' ])
+	pandoc, count = 'pandoc', 2000
+	for opt, arg in useroptions:
+		if opt == '--pandoc':
+			pandoc = arg
+		elif opt == '--random':
+			count = int(arg)
+
+	spec = importlib.util.spec_from_file_location('zettel_compose', COMPOSER)
+	zc = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(zc)
+
+	rnd = random.Random(SEED)
+	texts = CORPUS + [ random_text(rnd) for i in range(count) ] + [ note_text(pathname) for pathname in args ]
+
+	converted, failed = 0, 0
+	for text in texts:
+		latex = zc._md_to_latex(text)
+		if latex is None:
+			continue
+		converted += 1
+		expected = subprocess.run([ pandoc, '-f', 'markdown', '-t', 'latex' ], input=text,
+			stdout=subprocess.PIPE, encoding='utf-8', check=True).stdout.splitlines()
+		if latex != expected:
+			failed += 1
+			print('--- differs for:\n' + text + '\n--- pandoc:\n' + '\n'.join(expected) + '\n--- built-in:\n' + '\n'.join(latex) + '\n')
+
+	print('%d texts, %d converted without pandoc, %d different from pandoc' % (len(texts), converted, failed))
+	return 1 if failed else 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -5,10 +5,9 @@
 # 	by Bruno L. Conte <bruno@brunoc.com.br>, 2020-2022
 
 import re
-from glob import glob
 from collections import OrderedDict
-import os, time, sys, getopt
-import hashlib
+import os, io, time, sys, getopt, locale, shlex, signal
+import hashlib, unicodedata
 
 KEY_CITEKEY = 'citekey'
 KEY_LOCATION = 'loc'
@@ -45,9 +44,91 @@ options = {
 	'no-title': False,
 	'insert-bib-ref': False,
 	'no-front-matter': False,
-    'extract-mode': False
+    'extract-mode': False,
+	'renumber-footnotes': None, # None, 'note' or 'chapter'
+	'only': None, # note id, range of ids or heading to be rendered
+	'jobs': 1, # processes rendering notes
+	'first-text': 1, # number of the first quote (Tn)
+	'targets': None, # [ (output, options) ] composed in the same run
+	'check': False, # only check links
+	'state-file': None, # where notes and numbering are kept between runs
+	'notes-dirs': [], # where to look for notes, instead of the index's directory
+	'recursive': False, # also look in subdirectories
+	'cache-size': None, # bytes kept in note_cache, or no limit
+	'sync': None, # SQLite store to mirror the given directories into
+	'write-numbering': None, # where to write the numbering of notes
+	'external-numbering': [], # numbering of other manuscripts, for links to their notes
+	'split-on': None, # heading level or 'index': write a file for each chapter
+	'rev': None # git revision to read notes from, instead of the files
 }
 
+STATE_VERSION = 1
+STATE_IGNORED_OPTIONS = [ 'watch', 'verbose', 'sleep-time', 'jobs', 'check', 'state-file', 'cache-size', 'sync' ]
+
+class LRUCache(object):
+	"""
+	A mapping holding entries up to a budget of (estimated) bytes, evicting
+	those least recently used first. There is no limit if budget is None
+	"""
+	def __init__(self, budget=None):
+		self.entries = OrderedDict() # key -> (value, size)
+		self.budget = budget
+		self.size = 0
+		self.hits = self.misses = self.evictions = 0
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key, default=None):
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses += 1
+			return default
+		self.entries.move_to_end(key)
+		self.hits += 1
+		return entry[0]
+
+	def put(self, key, value, size):
+		self.discard(key)
+		self.entries[key] = (value, size)
+		self.size += size
+		self.evict()
+
+	def discard(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.size -= entry[1]
+
+	def evict(self):
+		while (self.budget is not None) and (self.size > self.budget) and self.entries:
+			key, (value, size) = self.entries.popitem(last=False)
+			self.size -= size
+			self.evictions += 1
+
+	def items(self):
+		return [ (key, entry[0]) for key, entry in self.entries.items() ]
+
+	def clear(self):
+		self.entries.clear()
+		self.size = 0
+
+	def report(self):
+		return '%d hits, %d misses, %d evictions, %d entries, about %d KB' % \
+			(self.hits, self.misses, self.evictions, len(self.entries), self.size // 1024)
+
+
+output_digests = {} # hashes of what was last written to each destination
+composed = False # whether z_stack and z_map are those of a finished composition
+note_cache = LRUCache() # pathname -> (mtime, md5hash, tokenized lines), and rendered fragments
+path_cache = None # zettel id -> (pathname, mtime), while composing
+external_notes = {} # zettel id -> (title, entry) from --external-numbering
+z_index = {} # zettel id -> pathname, see _z_build_index
+z_index_fresh = False # whether z_index was built during this composition or poll
+
+
 rx_dict = OrderedDict([
 	('ignore', re.compile(r'^(△|○)')),
 	('footnote', re.compile(r'\[\^(?P<fn_id>[a-zA-Z0-9_-]+)]')),
@@ -67,18 +148,634 @@ rx_dict = OrderedDict([
 	('title', re.compile(r"^title:\s*['\"](?P<id>.*)['\"]\s*$"))
 ])
 
+# note types are bit flags, so that membership tests are a single mask
+NT_INDEX = 1
+NT_BODY = 2
+NT_QUOTE = 4
+NT_SEQUENTIAL = 8
+NT_CITATION = 16
+NT_LEFT_TEXT = 32
+NT_RIGHT_TEXT = 64
+
+NT_TEXTS = NT_QUOTE | NT_LEFT_TEXT | NT_RIGHT_TEXT
+NT_STACKED = NT_INDEX | NT_BODY | NT_SEQUENTIAL | NT_CITATION | NT_TEXTS
+
+NT_NAMES = { NT_INDEX: 'index', NT_BODY: 'body', NT_QUOTE: 'quote', NT_SEQUENTIAL: 'sequential',
+	NT_CITATION: 'citation', NT_LEFT_TEXT: 'left-text', NT_RIGHT_TEXT: 'right-text' }
+
+class NoteRecord(object):
+	"""
+	An entry in z_map
+	"""
+	__slots__ = ('type', 'ref', 'path', 'mtime', 'md5hash', 'title')
+
+	def __init__(self, z_type, ref, path, mtime, md5hash, title=None):
+		self.type = z_type
+		self.ref = ref
+		self.path = path
+		self.mtime = mtime
+		self.md5hash = md5hash
+		self.title = title
+
 fields_dict = {
 	"citekey": re.compile(r'^' + KEY_CITEKEY + r':[ \t]*(?P<id>[A-Za-z\d:]+)\s*$'),
 	# "loc": re.compile(r'^' + KEY_LOCATION + r':[ \t]*(?P<id>[\d-]+)\s*$')
 	"loc": re.compile(r'^' + KEY_LOCATION + r':[ \t]*(?P<id>[\S]+)\s*$')
 }
 
+rx_fn_label = re.compile(r'\[\^(fn-[^\]\s]+)\]')
+rx_fn_definition = re.compile(r'^(>\s?)?\[\^fn-[^\]\s]+\]:')
+rx_chapter_heading = re.compile(r'^# ')
+
+class FootnoteStage(object):
+	"""
+	Renumber footnotes sequentially across the manuscript, moving their
+	definitions to the end of each note or of each chapter
+	"""
+	def __init__(self, at_chapter_end=False):
+		self.at_chapter_end = at_chapter_end
+		self.count = 0
+		self.labels = {} # labels seen in the current note
+		self.pending = [] # definitions not yet written
+
+	def _renumber(self, match):
+		label = match.group(1)
+		if label not in self.labels:
+			self.count += 1
+			self.labels[label] = str(self.count)
+		return '[^' + self.labels[label] + ']'
+
+	def process(self, lines):
+		"""
+		Renumber the footnotes in a composed note, holding back its definitions
+		"""
+		output = []
+		in_definition, quoted, held = False, False, []
+		for line in lines:
+			if in_definition:
+				body = _remove_md_quotes(line) if quoted else line
+				if body.strip() == '':
+					held.append(line)
+					continue
+				if body[0] in ' \t':	# indented continuation of the definition
+					self.pending = self.pending + ([''] * len(held)) + [ rx_fn_label.sub(self._renumber, body) ]
+					held = []
+					continue
+				in_definition = False
+				output = output + held
+				held = []
+
+			match = rx_fn_definition.match(line)
+			if match:
+				in_definition, quoted = True, (match.group(1) is not None)
+				self.pending.append(rx_fn_label.sub(self._renumber, line[match.end(1):] if quoted else line))
+			elif self.at_chapter_end and rx_chapter_heading.match(line):
+				output = output + self.flush() + [ line ]
+			else:
+				output.append(rx_fn_label.sub(self._renumber, line))
+
+		output = output + held
+		if not self.at_chapter_end:
+			output = output + self.flush()
+		self.labels = {} # labels are unique to each note
+		return output
+
+	def flush(self):
+		"""
+		Output the definitions held so far
+		"""
+		if not self.pending:
+			return []
+		output = [ '' ] + self.pending + [ '' ]
+		self.pending = []
+		return output
+
+SPLIT_WRITERS = 4 # threads writing chapter files
+
+class ChapterWriter(object):
+	"""
+	Output split into a file for each chapter (`Book-001.md`, `Book-002.md`
+	etc. for `Book.md`), listed in order in a manifest (`Book.manifest.json`).
+	Chapters are written on a pool of threads as soon as they are done, and
+	only if their content changed
+	"""
+	def __init__(self, output):
+		from concurrent.futures import ThreadPoolExecutor
+
+		self.base, self.ext = os.path.splitext(output)
+		self.manifest = _manifest_name(output)
+		self.pool = ThreadPoolExecutor(SPLIT_WRITERS)
+		self.new_mode = _new_file_mode()	# read here, not in the writing threads
+		self.writes = []
+		self.chapters = []
+		self.f_out = None
+		self.start()
+
+	def start(self):
+		"""
+		End the current chapter, going on in a new file
+		"""
+		self.close()
+		self.f_out = io.StringIO()
+		self.chapters.append(OrderedDict([ ('file', '%s-%03d%s' % (self.base, len(self.chapters) + 1, self.ext)), ('notes', []) ]))
+
+	def write(self, s):
+		self.f_out.write(s)
+
+	def close(self):
+		if self.f_out is None:
+			return
+		chapter, content = self.chapters[-1], self.f_out.getvalue()
+		if _output_changed(chapter['file'], content, chapter['file']):
+			self.writes.append(self.pool.submit(_write_atomically, chapter['file'], content, self.new_mode))
+		chapter['heading'] = next((line for line in content.splitlines() if rx_dict['md_heading'].match(line)), None)
+		chapter['md5'] = output_digests[chapter['file']]
+		self.f_out = None
+
+	def finish(self):
+		"""
+		Wait for the chapters to be written, then remove the files of chapters
+		gone since the last run and write the manifest
+		"""
+		import json
+
+		self.close()
+		self.pool.shutdown(wait=True)
+		for write in self.writes:
+			write.result()
+		directory = os.path.dirname(self.manifest)
+		files = set(chapter['file'] for chapter in self.chapters)
+		for pathname in _manifest_files(self.manifest):
+			if pathname not in files:
+				try:
+					os.remove(pathname)
+				except OSError:
+					pass
+				output_digests.pop(pathname, None)
+		for chapter in self.chapters:
+			chapter['file'] = os.path.relpath(chapter['file'], directory or os.curdir)
+		content = json.dumps(OrderedDict([ ('chapters', self.chapters) ]), indent=1, ensure_ascii=False) + '\n'
+		if _output_changed(self.manifest, content, self.manifest):
+			_write_atomically(self.manifest, content)
+
+def _manifest_name(output):
+	return os.path.splitext(output)[0] + '.manifest.json'
+
+def _manifest_files(manifest):
+	"""
+	Pathnames of the chapter files listed in a manifest, if there is one
+	"""
+	import json
+
+	try:
+		with open(manifest, encoding='utf-8') as f:
+			chapters = json.load(f)['chapters']
+	except (OSError, ValueError, KeyError, TypeError):
+		return []
+	directory = os.path.dirname(manifest)
+	return [ os.path.join(directory, chapter['file']) for chapter in chapters ]
+
+def _heading_level(line):
+	return len(line) - len(line.lstrip('#'))
+
+def _index_sections(pathname):
+	"""
+	Number of the top level section of the index note in which each note is
+	first linked, for --split-on=index
+	"""
+	lines, in_yaml = [], False
+	for line, tokens in _z_note_contents(pathname, z_map['index'].mtime)[2]:
+		key = tokens[0][0] if tokens else None
+		if in_yaml or (key == 'yaml_div'):
+			in_yaml = (not in_yaml) or (key not in [ 'yaml_div', 'yaml_end_div' ])
+		elif key != 'ignore':
+			lines.append((line, tokens))
+	levels = [ _heading_level(line) for line, tokens in lines if tokens and tokens[0][0] == 'md_heading' ]
+	top = min(levels) if levels else None
+	sections, section = {}, 0
+	for line, tokens in lines:
+		if tokens and (tokens[0][0] == 'md_heading') and (_heading_level(line) == top):
+			section += 1
+		for key, match, end in tokens:
+			if key in LINK_KEYS:
+				sections.setdefault(match['id'], section)
+	return sections
+
 def _initialize_stack():
-	global z_count, z_stack, z_map, unindexed_links
-	z_count = { "index": 0, "body": 0, "quote": 0, "sequential": 0, "citation": 0, "left_text": 0, "right_text": 0 }
+	global z_count, z_stack, z_map, unindexed_links, z_headings
+	z_count = { NT_INDEX: 0, NT_BODY: 0, NT_QUOTE: options['first-text'] - 1, NT_SEQUENTIAL: 0, NT_CITATION: 0, NT_LEFT_TEXT: 0, NT_RIGHT_TEXT: 0 }
 	z_stack = []
 	z_map = {} # maps zettel id's to paragraph or sequence
 	unindexed_links = []
+	z_headings = {} # leading headings of notes, collected by LinkWalk
+	for key in [ key for key, entry in note_cache.items() if isinstance(key, tuple) ]:
+		note_cache.discard(key)	# rendered fragments depend on numbering and options
+
+class DirectorySource(object):
+	"""
+	Notes stored as files. Every note source has the same methods: scan(root)
+	lists the pathnames under a directory, mtime(pathname) returns a stamp
+	that changes with the note (raising OSError if it is gone), read(pathname)
+	its contents, digest(pathname, content) a hash of them and
+	fields(pathname, mtime) its citation fields
+	"""
+	def scan(self, root):
+		directories = [ root ]
+		while directories:
+			directory = directories.pop()
+			subdirectories = []
+			with os.scandir(directory or os.curdir) as entries:
+				for entry in sorted(entries, key=lambda entry: entry.name):
+					if entry.is_dir(follow_symlinks=False):
+						if options['recursive'] and not entry.name.startswith('.'):
+							subdirectories.append(os.path.join(directory, entry.name))
+					else:
+						yield os.path.join(directory, entry.name)
+			directories.extend(reversed(subdirectories))
+
+	def mtime(self, pathname):
+		return os.path.getmtime(pathname)
+
+	def read(self, pathname):
+		with open(pathname, 'rb') as a_file:
+			return a_file.read()
+
+	def digest(self, pathname, content):
+		return hashlib.md5(content).hexdigest()
+
+	def fields(self, pathname, mtime):
+		return _note_fields(line for line, tokens in _z_note_contents(pathname, mtime)[2])
+
+	def refresh(self):
+		pass
+
+class BundleSource(DirectorySource):
+	"""
+	Notes in a zip or tar file, read without extracting it. Members are
+	addressed as if the archive were a directory: `notes.zip/1000 Index.md`
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.open()
+
+	def open(self):
+		self.mtime_of_bundle = os.path.getmtime(self.path)
+		self.members = {} # pathname -> member
+		for name, member in self.list_members():
+			parts = [ part for part in name.split('/') if part not in ('', '.') ]
+			self.members[os.path.join(self.path, *parts)] = member
+
+	def refresh(self):
+		"""
+		Read the archive's directory again if the archive was replaced
+		"""
+		if os.path.getmtime(self.path) != self.mtime_of_bundle:
+			self.open()
+
+	def scan(self, root):
+		prefix = os.path.join(root, '')
+		found = []
+		for pathname in self.members:
+			if not pathname.startswith(prefix):
+				continue
+			parts = pathname[len(prefix):].split(os.sep)
+			if (len(parts) > 1) and not options['recursive']:
+				continue
+			if any(part.startswith('.') for part in parts[:-1]):
+				continue
+			# the order of a directory walk: files first, then subdirectories
+			found.append(([ (1, part) for part in parts[:-1] ] + [ (0, parts[-1]) ], pathname))
+		return [ pathname for key, pathname in sorted(found) ]
+
+	def member(self, pathname):
+		try:
+			return self.members[pathname]
+		except KeyError:
+			raise FileNotFoundError(pathname)
+
+class ZipSource(BundleSource):
+	"""
+	Notes in a zip file. Its central directory gives the CRC of each note,
+	which is used as its hash
+	"""
+	archive = None
+
+	def list_members(self):
+		import zipfile
+		if self.archive is not None:
+			self.archive.close()	# the file was replaced
+		self.archive = zipfile.ZipFile(self.path)
+		return [ (info.filename, info) for info in self.archive.infolist() if not info.is_dir() ]
+
+	def mtime(self, pathname):
+		info = self.member(pathname)
+		return info.date_time, info.CRC
+
+	def read(self, pathname):
+		return self.archive.read(self.member(pathname))
+
+	def digest(self, pathname, content):
+		info = self.member(pathname)
+		return '%08x-%d' % (info.CRC, info.file_size)
+
+class TarSource(BundleSource):
+	"""
+	Notes in a tar file. Members of an uncompressed tar are read where its
+	headers say they are; a compressed tar is read through once, since it
+	can't be read out of order
+	"""
+	archive = None
+
+	def list_members(self):
+		import tarfile
+		if self.archive is not None:
+			self.archive.close()	# the file was replaced
+		try:
+			self.archive = tarfile.open(self.path, 'r:')
+			self.contents = None
+		except tarfile.ReadError:
+			self.archive = tarfile.open(self.path, 'r:*')
+			self.contents = {}
+		members = []
+		for member in self.archive:
+			if member.isfile():
+				members.append((member.name, member))
+				if self.contents is not None:
+					self.contents[member.name] = self.archive.extractfile(member).read()
+		return members
+
+	def mtime(self, pathname):
+		member = self.member(pathname)
+		return member.mtime, member.size
+
+	def read(self, pathname):
+		member = self.member(pathname)
+		if self.contents is not None:
+			return self.contents[member.name]
+		return self.archive.extractfile(member).read()
+
+STORE_VERSION = 1
+STORE_SCHEMA = """
+	CREATE TABLE IF NOT EXISTS notes (
+		name TEXT PRIMARY KEY,	-- pathname relative to the synced directory, with '/'
+		mtime REAL,
+		size INTEGER,
+		hash TEXT,
+		content BLOB,
+		citekey TEXT,
+		loc TEXT
+	)
+"""
+
+class SqliteSource(BundleSource):
+	"""
+	Notes mirrored into a single SQLite file by --sync, with their hashes and
+	citation fields. The list of notes is read with one query; each note is
+	then a lookup by primary key, instead of a stat, an open and a read
+	"""
+	db = None
+
+	def list_members(self):
+		import sqlite3
+		from urllib.parse import quote
+		if self.db is not None:
+			self.db.close()	# the file was replaced
+		self.db = sqlite3.connect('file:' + quote(os.path.abspath(self.path)) + '?mode=ro', uri=True)
+		if self.db.execute('PRAGMA user_version').fetchone()[0] != STORE_VERSION:
+			self.db.close()
+			self.db = None
+			raise ValueError(self.path + " was not written by this version of zettel-compose.py, run --sync again")
+		return [ (row[0], row) for row in self.db.execute('SELECT name, mtime, hash, citekey, loc FROM notes') ]
+
+	def mtime(self, pathname):
+		return self.member(pathname)[1]
+
+	def read(self, pathname):
+		return self.db.execute('SELECT content FROM notes WHERE name = ?', (self.member(pathname)[0],)).fetchone()[0]
+
+	def digest(self, pathname, content):
+		return self.member(pathname)[2]
+
+	def fields(self, pathname, mtime):
+		name, mtime, md5hash, citekey, loc = self.member(pathname)
+		return { 'citekey': citekey, 'loc': loc }
+
+def sync_store(store_pathname, directories):
+	"""
+	Mirror the notes in directories into an SQLite store. Only notes whose
+	mtime or size changed are read; notes no longer found are removed
+	"""
+	import sqlite3
+
+	db = sqlite3.connect(store_pathname)
+	db.executescript(STORE_SCHEMA)
+	db.execute('PRAGMA user_version = %d' % STORE_VERSION)
+	stored = dict((name, (mtime, size)) for name, mtime, size in db.execute('SELECT name, mtime, size FROM notes'))
+	seen = set()
+	updated = 0
+	for directory in directories:
+		for pathname in directory_source.scan(directory):
+			if not rx_note_filename.match(os.path.basename(pathname)):
+				continue
+			name = '/'.join(os.path.relpath(pathname, directory).split(os.sep))
+			if name in seen:
+				continue
+			seen.add(name)
+			stat = os.stat(pathname)
+			if stored.get(name) == (stat.st_mtime, stat.st_size):
+				continue
+			content = directory_source.read(pathname)
+			fields = _note_fields(content.decode(locale.getpreferredencoding(False)).splitlines())
+			db.execute('INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?, ?, ?)', (name, stat.st_mtime, stat.st_size,
+				hashlib.md5(content).hexdigest(), content, fields['citekey'], fields['loc']))
+			updated += 1
+	removed = [ (name,) for name in stored if name not in seen ]
+	db.executemany('DELETE FROM notes WHERE name = ?', removed)
+	db.commit()
+	db.close()
+	if options['verbose']:
+		print("%d notes in %s: %d updated, %d removed" % (len(seen), store_pathname, updated, len(removed)))
+
+class GitSource(BundleSource):
+	"""
+	Notes as of a git revision (--rev), read from the repository without
+	checking anything out. The revision's tree is listed once; notes are read
+	through a single `git cat-file --batch` process, and their blob ids serve
+	as their mtime and hash
+	"""
+	def __init__(self, path, rev):
+		self.rev = rev
+		self.batch = None
+		self.keys = {} # pathname as given -> pathname in the repository
+		BundleSource.__init__(self, path)
+
+	def git(self, *args):
+		import subprocess
+		return subprocess.run([ 'git', '-C', self.path ] + list(args), stdout=subprocess.PIPE, check=True).stdout
+
+	def resolve(self):
+		import subprocess
+		try:
+			return self.git('rev-parse', '--verify', '--quiet', self.rev + '^{commit}').decode('ascii').strip()
+		except subprocess.CalledProcessError:
+			raise ValueError("--rev: no commit " + self.rev + " in " + self.path)
+
+	def open(self):
+		self.commit = self.resolve()
+		self.members = {} # pathname -> blob id
+		for entry in self.git('ls-tree', '-r', '-z', '--full-tree', self.commit).split(b'\0'):
+			if entry:
+				info, name = entry.split(b'\t', 1)
+				mode, kind, blob = info.split()
+				if kind == b'blob':
+					self.members[os.path.join(self.path, *os.fsdecode(name).split('/'))] = blob.decode('ascii')
+		if options['verbose']:
+			print("Reading notes from " + self.path + " at " + self.commit[:12])
+
+	def refresh(self):
+		"""
+		List the tree again if the revision moved, e. g. HEAD after a commit
+		"""
+		if self.resolve() != self.commit:
+			self.open()
+
+	def scan(self, root):
+		real_root = os.path.realpath(root)
+		prefix = len(os.path.join(real_root, ''))
+		return [ os.path.join(root, pathname[prefix:]) for pathname in BundleSource.scan(self, real_root) ]
+
+	def member(self, pathname):
+		key = self.keys.get(pathname)
+		if key is None:
+			key = self.keys[pathname] = os.path.join(os.path.realpath(os.path.dirname(pathname)), os.path.basename(pathname))
+		return BundleSource.member(self, key)
+
+	def mtime(self, pathname):
+		return self.member(pathname)
+
+	def read(self, pathname):
+		import subprocess
+		blob = self.member(pathname)
+		if self.batch is None:
+			self.batch = subprocess.Popen([ 'git', '-C', self.path, 'cat-file', '--batch' ],
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		self.batch.stdin.write(blob.encode('ascii') + b'\n')
+		self.batch.stdin.flush()
+		header = self.batch.stdout.readline().split()	# blob id, type and size, or "<id> missing"
+		if len(header) != 3:
+			raise FileNotFoundError(pathname)
+		return self.batch.stdout.read(int(header[2]) + 1)[:-1]
+
+	def digest(self, pathname, content):
+		return self.member(pathname)
+
+directory_source = DirectorySource()
+note_sources = {} # directory or note pathname -> source of the notes in it
+
+def _open_bundle(path):
+	import zipfile, tarfile
+
+	for source in note_sources.values():
+		if isinstance(source, BundleSource) and (source.path == path):
+			return source
+	with open(path, 'rb') as f:
+		if f.read(16) == b'SQLite format 3\x00':
+			return SqliteSource(path)
+	if zipfile.is_zipfile(path):
+		return ZipSource(path)
+	if tarfile.is_tarfile(path):
+		return TarSource(path)
+	raise ValueError(path + " is not a directory, nor a zip, tar or SQLite file")
+
+def _git_source(directory):
+	"""
+	Source of the notes of the git repository holding a directory, as of
+	--rev. The directory need not exist any more in the working tree
+	"""
+	import subprocess
+
+	parent = directory or os.curdir
+	while not os.path.isdir(parent) and (parent != os.path.dirname(parent)):
+		parent = os.path.dirname(parent) or os.curdir
+	try:
+		top = subprocess.run([ 'git', '-C', parent, 'rev-parse', '--show-toplevel' ], stdout=subprocess.PIPE,
+			stderr=subprocess.DEVNULL, check=True).stdout
+	except (OSError, subprocess.CalledProcessError):
+		raise ValueError("--rev: " + (directory or os.curdir) + " is not in a git repository")
+	top = os.path.realpath(os.fsdecode(top.rstrip(b'\n')))
+	for source in note_sources.values():
+		if isinstance(source, GitSource) and (source.path == top):
+			return source
+	return GitSource(top, options['rev'])
+
+def _directory_source(directory):
+	"""
+	Source of the notes in a directory: a zip, tar or SQLite file if the
+	directory is, or is inside, one; with --rev, the git repository it is in
+	"""
+	source = note_sources.get(directory)
+	if source is None and options['rev']:
+		source = note_sources[directory] = _git_source(directory)
+	if source is None:
+		source = directory_source
+		parent = directory
+		while parent and not os.path.isdir(parent):
+			if os.path.isfile(parent):
+				source = _open_bundle(parent)
+				break
+			if parent == os.path.dirname(parent):
+				break
+			parent = os.path.dirname(parent)
+		note_sources[directory] = source
+	return source
+
+def _note_source(pathname):
+	source = note_sources.get(pathname)
+	if source is None:
+		source = note_sources[pathname] = _directory_source(os.path.dirname(pathname))
+	return source
+
+rx_note_filename = re.compile(r'^(?P<id>\d{3,})[ .]')
+
+def _scan_notes(roots):
+	"""
+	Map note ids to the pathnames of their files, walking each directory
+	under the search roots once
+	"""
+	files = {}
+	for root in roots:
+		for pathname in _directory_source(root).scan(root):
+			match = rx_note_filename.match(os.path.basename(pathname))
+			if match:
+				files.setdefault(match.group('id'), []).append(pathname)
+	return files
+
+def _search_roots(index_pathname):
+	return options['notes-dirs'] or [ os.path.dirname(index_pathname) ]
+
+def _z_build_index():
+	"""
+	Map every note id to a pathname at once, instead of looking up each note
+	"""
+	global z_index, z_index_fresh
+	z_index = dict((zettel_id, pathnames[0]) for zettel_id, pathnames in _scan_notes(_search_roots(index_filename)).items())
+	z_index_fresh = True
+
+def _z_lookup(zettel_id):
+	"""
+	Pathname and mtime of a note. The id index is built again, at most once
+	per composition, when a note is not in it or was moved
+	"""
+	for attempt in [ 0, 1 ]:
+		if zettel_id in z_index:
+			try:
+				return z_index[zettel_id], _note_source(z_index[zettel_id]).mtime(z_index[zettel_id])
+			except OSError:
+				pass
+		if z_index_fresh:
+			break
+		_z_build_index()
+	raise LookupError(zettel_id)
 
 def _z_get_filepath(zettel_id):
 	"""
@@ -86,15 +783,19 @@ def _z_get_filepath(zettel_id):
 	"""
 	global zettel_dir, index_filename
 
+	if path_cache is not None and zettel_id in path_cache:
+		return path_cache[zettel_id]
 	try:
 		if (zettel_id == "index"):
 			fn = index_filename
+			mtime = _note_source(fn).mtime(fn)
 		else:
-			fn = glob(zettel_dir + "/" + zettel_id + "[ \.]*")[0]
-		mtime = os.path.getmtime(fn)
+			fn, mtime = _z_lookup(zettel_id)
 	except:
 		print("ERROR: file not found for zettel " + zettel_id)
 		fn, mtime = None, None
+	if path_cache is not None:
+		path_cache[zettel_id] = fn, mtime
 	return fn, mtime
 
 def _get_file_md5digest(pathname):
@@ -108,11 +809,84 @@ def _get_file_md5digest(pathname):
 
 	return digest
 
+# keys of rx_dict anchored at the start of a line, by its first character
+RX_LINE_STARTS = { '△': 'ignore', '○': 'ignore', '.': 'yaml_end_div', '-': 'yaml_div', '#': 'md_heading', 't': 'title' }
+# the other keys of rx_dict, with a string a line must hold for them to match,
+# besides `[[` for links
+RX_MARKERS = [ ('footnote', '[^'), ('parallel_texts', '::'), ('pandoc_cite_noauthor', '-@'), ('pandoc_cite_inline', '@@'),
+	('pandoc_cite', '@'), ('no_ref', '-'), ('quote', '>'), ('add_ref', '+'), ('link', '§'), ('cross_ref_alt', ':'),
+	('cross_ref', '[[') ]
+
+rx_stages = {} # (first character, markers found) -> the (key, regex) of rx_dict to try
+
+def _line_regexes(line):
+	"""
+	The entries of rx_dict that may match a line, in their order, told by
+	cheap tests: its first character, and the strings it holds. Lines with
+	neither a link nor a footnote take at most one regex
+	"""
+	first = line[:1]
+	if first not in RX_LINE_STARTS:
+		first = ''
+	found, bit = 0, 1
+	if '[[' in line:
+		for key, marker in RX_MARKERS:
+			if marker in line:
+				found |= bit
+			bit <<= 1
+	elif '[^' in line:
+		found = 1
+	regexes = rx_stages.get((first, found))
+	if regexes is None:
+		keys = set(key for i, (key, marker) in enumerate(RX_MARKERS) if found & (1 << i))
+		keys.add(RX_LINE_STARTS.get(first))	# None for other lines
+		regexes = rx_stages[first, found] = [ (key, rx) for key, rx in rx_dict.items() if key in keys ]
+	return regexes
+
+def _tokenize_line(line):
+	"""
+	Split a line into the tokens parse_zettel works on: a list of (key,
+	groups, end) for each match found in what is left of the line
+	"""
+	tokens = []
+	while True:
+		regexes = _line_regexes(line)
+		if not regexes:
+			return tokens
+		key, match, end = _first_match(line, regexes)
+		if key is None:
+			return tokens
+		tokens.append((key, match.groupdict(), end))
+		line = line[end:]
+
+def _z_note_contents(pathname, mtime, digest=True):
+	"""
+	Content hash and tokenized lines of a note. Notes are read once, and
+	read again only when their mtime changes. Without digest, the hash is
+	not computed (and is None) unless the note was hashed already
+	"""
+	cached = note_cache.get(pathname)
+	if cached is None or cached[0] != mtime or (digest and cached[1] is None):
+		source = _note_source(pathname)
+		content = source.read(pathname)
+		md5hash = source.digest(pathname, content) if digest else None
+		lines = content.decode(locale.getpreferredencoding(False)).splitlines()
+		cached = (mtime, md5hash, [ (line, _tokenize_line(line)) for line in lines ])
+		note_cache.put(pathname, cached, _note_size(cached))
+	return cached
+
+def _note_size(cached):
+	"""
+	Rough size in memory of a tokenized note: its text, plus what lines
+	and tokens cost as Python objects
+	"""
+	return sum(len(line) + 120 + 330 * len(tokens) for line, tokens in cached[2])
+
 def _z_set_index(pathname):
 	global z_map, z_stack
-	mtime = os.path.getmtime(pathname)
-	md5hash = _get_file_md5digest(pathname)
-	z_map["index"] = { "type": "index", "ref": 0, "path": pathname, "mtime": mtime, "md5hash": md5hash }
+	mtime = _note_source(pathname).mtime(pathname)
+	md5hash = _z_note_contents(pathname, mtime)[1]
+	z_map["index"] = NoteRecord(NT_INDEX, 0, pathname, mtime, md5hash)
 	if len(z_stack) == 0:
 		z_stack.append("index")
 
@@ -124,15 +898,15 @@ def _z_add_to_stack(zettel_id, z_type):
 	global z_stack
 
 	if not zettel_id in z_map:
-		if z_type == 'right_text':
-			z_ref_type = 'quote' # counts as quote for numbering texts
+		if z_type == NT_RIGHT_TEXT:
+			z_ref_type = NT_QUOTE # counts as quote for numbering texts
 		else:
 			z_ref_type = z_type
 		z_count[z_ref_type] += 1
 		path, mtime = _z_get_filepath(zettel_id)
-		md5hash = _get_file_md5digest(path)
-		z_map[zettel_id] = { "type": z_type, "ref": z_count[z_ref_type], "path": path, "mtime": mtime, "md5hash": md5hash }
-		if z_type in [ 'body', 'index', 'quote', 'citation', 'sequential', 'left_text', 'right_text' ]:
+		md5hash = _z_note_contents(path, mtime)[1]
+		z_map[zettel_id] = NoteRecord(z_type, z_count[z_ref_type], path, mtime, md5hash)
+		if z_type & NT_STACKED:
 			z_stack.append(zettel_id)
 	return z_map[zettel_id]
 
@@ -149,6 +923,17 @@ def _out_link(ref, id):
 		else:
 			return " (" + options['section-symbol'] + str(ref) + ")"
 
+def _out_external_link(zettel_id):
+	"""
+	Formatted output for a link to a note of another manuscript, numbered
+	as in its --write-numbering map
+	"""
+	title, entry = external_notes[zettel_id]
+	prefix = title + ", " if title else ""
+	if entry['type'] in [ NT_NAMES[z_type] for z_type in NT_NAMES if z_type & NT_TEXTS ]:
+		return prefix + _out_quoteref(entry['ref'], zettel_id)
+	return " (" + prefix + options['section-symbol'] + str(entry['ref']) + ")"
+
 def _out_linked_zettel(id, anchor):
 	return '[' + anchor + '](' + options['custom-url'] + str(id) + ')'
 
@@ -190,59 +975,224 @@ def _out_unindexed_notes():
 	output = [ STR_UNINDEXED_HEADING, "", ""]
 	for n in unindexed_links:
 		base = os.path.basename(_z_get_filepath(n)[0])
-		output.append(os.path.splitext(base)[0] + " " + _out_link(z_map[n]['ref'], n) + ".")
+		output.append(os.path.splitext(base)[0] + " " + _out_link(z_map[n].ref, n) + ".")
 	return output
 
-def _out_latex_parallel_texts(left_text, right_text):
+# Markdown converted to LaTeX without pandoc, when it only holds what is
+# supported below: paragraphs of text with emphasis and footnotes. The
+# result is what `pandoc -f markdown -t latex` would give, wrapped alike
+LATEX_COLUMNS = 72
+LATEX_ESCAPES = { '&': '\\&', '%': '\\%', '#': '\\#', '\xa0': '~', '…': '\\ldots\x03', '—': '---', '–': '--',
+	'’': "'", '‘': '`', '“': '``', '”': "''" }
+LATEX_PUNCTUATION = set(' .,;:!?()/+=*\'-§°«»·' + ''.join(LATEX_ESCAPES))
+# pandoc's abbreviations, followed by a non-breaking space
+LATEX_ABBREVIATIONS = set("""aet. aetat. al. Apr. Aug. bk. Bros. c. Capt. cf. ch. chap. chs. Co. col. Corp. cp. d.
+	Dec. Dr. e.g. ed. eds. esp. f. fasc. Feb. ff. fig. fl. fol. fols. Fr. Gen. Gov. Hon. i.e. ill. Inc. incl. Jan. Jr.
+	Jul. Jun. Ltd. M.A. M.D. Mar. Mr. Mrs. Ms. n. n.b. nn. No. Nov. Oct. p. Ph.D. pp. Pres. Prof. pt. q.v. Rep. Rev.
+	s.v. s.vv. saec. sec. Sen. Sep. Sept. Sgt. Sr. St. univ. viz. vol. vs.""".split())
+
+rx_md_block = re.compile(r'^(\s|[#>+=:|~`<(-]|\*\s|\d+[.)]|([ivxlcdmIVXLCDM]+|[a-zA-Z])[.)](\s|$))')
+rx_md_fn_definition = re.compile(r'^\[\^(?P<id>[^\]\s]+)\]:\s*')
+rx_md_fn_reference = re.compile(r'\[\^([^\]\s]+)\]')
+rx_md_strong = re.compile(r'\*\*(?![\s*])(.+?)(?<![\s*])\*\*')
+rx_md_emphasis = re.compile(r'\*(?![\s*])(.+?)(?<![\s*])\*')
+rx_md_apostrophe = re.compile(r"(?<![^\W_])'")
+rx_md_abbreviation = re.compile(r'(?<![^\W_])[^\W_](?:[^\W_]|\.(?!\.))*$')
+rx_md_adjacent_quotes = re.compile(r"(?<=['‘’“”])(?=[‘’“”])")	# pandoc puts a thin space between them
+rx_md_dash_run = re.compile(r'[-–—][–—]|[–—]-')	# pandoc has its own ways with these
+rx_latex_control_end = re.compile(r'\x03(.?)')
+
+def _md_inline_to_latex(lines):
+	"""
+	LaTeX for the text of a paragraph, with spaces where lines may be
+	broken; None if it uses anything else than emphasis
+	"""
+	words = []
+	for line in lines:
+		tokens = line.split(' ')
+		for i, token in enumerate(tokens):
+			if not token:
+				continue
+			for c in token:
+				if not (c.isalnum() or (c in LATEX_PUNCTUATION)):
+					return None
+			if ('....' in token) or ('***' in token) or rx_md_apostrophe.search(token) or rx_md_dash_run.search(token):
+				return None
+			pieces = rx_md_adjacent_quotes.split(token.replace('...', '…'))
+			token = '\\,'.join(''.join(LATEX_ESCAPES.get(c, c) for c in piece) for piece in pieces)
+			match = rx_md_abbreviation.search(token)
+			if (i < len(tokens) - 1) and match and (match.group(0) in LATEX_ABBREVIATIONS):
+				tokens[i + 1] = token + '\xa0' + tokens[i + 1]	# joined to the next word
+				continue
+			words.append(token.replace('\xa0', '~'))
+	text = ' '.join(words)
+	text = rx_md_strong.sub(lambda match: '\\textbf{' + match.group(1) + '}', text)
+	text = rx_md_emphasis.sub(lambda match: '\\emph{' + match.group(1) + '}', text)
+	if '*' in text:
+		return None
+
+	def end_control_word(match):
+		if match.group(1).isalpha():
+			return '\x04' + match.group(1)	# a space that is not a break
+		if match.group(1) in ('', ' ', '}'):
+			return '{}' + match.group(1)
+		return match.group(1)
+	return rx_latex_control_end.sub(end_control_word, text)
+
+def _latex_width(text):
+	width = 0
+	for c in text:
+		if unicodedata.combining(c) or c in '\x01\x02':
+			continue
+		width += 2 if unicodedata.east_asian_width(c) in 'WF' else 1
+	return width
+
+def _wrap_latex(text):
+	"""
+	Fill lines up to LATEX_COLUMNS, as pandoc does. Footnotes, between
+	\\x01 and \\x02, are indented when broken
+	"""
+	lines, line, width, depth = [], '', 0, 0
+	for word in text.split(' '):
+		word_width = _latex_width(word)
+		fitting = word_width - word.count('\x02')	# the brace closing a footnote may overflow
+		if '\x01' in word:	# and so may what follows its start, but for a character
+			fitting = _latex_width(word[:word.index('\x01')]) + 1
+		if not line:
+			line, width = word, word_width
+		elif width + 1 + fitting <= LATEX_COLUMNS:
+			line, width = line + ' ' + word, width + 1 + word_width
+		else:
+			lines.append(line)
+			line, width = '  ' * depth + word, 2 * depth + word_width
+		depth += word.count('\x01') - word.count('\x02')
+	lines.append(line)
+	return [ line.replace('\x01', '').replace('\x02', '').replace('\x04', ' ') for line in lines ]
+
+def _md_to_latex(text):
+	"""
+	Convert simple Markdown to LaTeX in process; None if it takes pandoc
+	"""
+	if text.startswith('%'):
+		return None	# a title block
+	blocks, notes = [], {}
+	for block in re.split(r'\n[ \t]*\n', text.strip('\n')):
+		lines = block.split('\n')
+		if rx_md_fn_definition.match(lines[0]):
+			for line in lines:
+				match = rx_md_fn_definition.match(line)
+				if match:
+					if (match.group('id') in notes) or rx_md_block.match(line[match.end():]):
+						return None
+					note = notes[match.group('id')] = [ line[match.end():] ]
+				elif rx_md_block.match(line) or rx_md_fn_reference.search(line):
+					return None
+				else:
+					note.append(line)
+			continue
+		for line in lines:
+			if rx_md_block.match(line) or line.endswith('  ') or rx_md_fn_definition.match(line):
+				return None
+		blocks.append(lines)
+
+	for label in notes:
+		notes[label] = _md_inline_to_latex(notes[label])
+		if not notes[label]:
+			return None
+	output = []
+	for lines in blocks:
+		if not ''.join(lines).strip():
+			continue
+		parts = rx_md_fn_reference.split('\n'.join(lines))
+		latex = []
+		for i, part in enumerate(parts):
+			if i % 2:
+				if part not in notes:
+					return None
+				latex.append('\\footnote{\x01' + notes[part] + '\x02}')
+			else:
+				inline = _md_inline_to_latex(part.split('\n'))
+				if inline is None:
+					return None
+				if inline and part.startswith((' ', '\n')):
+					inline = ' ' + inline
+				if part.endswith((' ', '\n')) and (i < len(parts) - 1):
+					inline = inline + ' '	# a space before a footnote
+				latex.append(inline)
+		if output:
+			output.append('')
+		output = output + _wrap_latex(''.join(latex))
+	return output or [ '' ]	# as pandoc for a blank text
+
+def _pandoc_latex(lines):
 	import subprocess
 
 	CMD = [CF_PANDOC, '-f', 'markdown', '-t', 'latex']
 
 	ps = subprocess.Popen(CMD,stdin=subprocess.PIPE,stdout=subprocess.PIPE,encoding="utf-8")
-	left_text = (ps.communicate(input='\n'.join(left_text))[0]).splitlines()
-
-	ps = subprocess.Popen(CMD,stdin=subprocess.PIPE,stdout=subprocess.PIPE,encoding="utf-8")
-	right_text = (ps.communicate(input="\n".join(right_text))[0]).splitlines()
+	return (ps.communicate(input='\n'.join(lines))[0]).splitlines()
 
-	output = ['\ParallelTexts{%'] + left_text + ['}{%'] + right_text + ['}'] + ['']
+def _out_latex_parallel_texts(left_text, right_text):
+	"""
+	Parallel texts in LaTeX, converted by pandoc unless they are simple
+	enough to be converted here (see _md_to_latex)
+	"""
+	left_latex = _md_to_latex('\n'.join(left_text))
+	if left_latex is None:
+		left_latex = _pandoc_latex(left_text)
+	right_latex = _md_to_latex('\n'.join(right_text))
+	if right_latex is None:
+		right_latex = _pandoc_latex(right_text)
+
+	output = ['\ParallelTexts{%'] + left_latex + ['}{%'] + right_latex + ['}'] + ['']
 	return output
 
 def _out_parallel_texts(left, right):
-	left_data = parse_zettel(z_map[left], left)
-	right_data = parse_zettel(z_map[right], right)
+	"""
+	Fragment for parallel texts (see _expand_fragment)
+	"""
+	left_data, right_data = [], []
+	yield _zettel_fragment(z_map[left], left), left_data
+	yield _zettel_fragment(z_map[right], right), right_data
 	output = []
 	if not options['handout-mode']: # qual será o padrão? esperar quotes nas fichas ou não?
 		if ('l' in options['parallel-texts-selection']):
-			output.append(_out_text_quote(z_map[left]["ref"], left))
+			output.append(_out_text_quote(z_map[left].ref, left))
 			output = output + left_data
 		else:
-			output.append(_out_text_quote(z_map[right]["ref"], right))
+			output.append(_out_text_quote(z_map[right].ref, right))
 		if ('r' in options['parallel-texts-selection']):
 			output.append('> ')
 			if ('l' in options['parallel-texts-selection']):
 				output.append("> " + _out_commented_id(right, pre=STR_SIGN_INSERT) + '  ')
 			output = output + right_data
 	else:
-		output.append(STR_HANDOUT_HEADING + ' ' + z_map[right]['title'])
+		output.append(STR_HANDOUT_HEADING + ' ' + z_map[right].title)
 		output.append('')
 		if not options['parallel-texts-processor']:
 			output = output + left_data + ['\n'] + right_data
 		else:
 			output = output + _out_latex_parallel_texts(left_data, right_data)
 
-	return output
+	for line in output:
+		yield line
 
 def _parse_line(line, thedict):
-	l = [ ]
-	for key, rx in thedict.items():
+	return _first_match(line, thedict.items())
+
+def _first_match(line, regexes):
+	"""
+	Key, match and end of the earliest match of any (key, regex) in a line;
+	the first one listed wins a tie
+	"""
+	first_key, first = None, None
+	for key, rx in regexes:
 		match = rx.search(line)
-		if match:
-			l.append((key, match))
-	if l:
-		r = sorted(l, key=lambda x: x[1].start())[0]
-		return r[0], r[1], r[1].end()
-	else:
+		if match and ((first is None) or (match.start() < first.start())):
+			first_key, first = key, match
+	if first is None:
 		return None, None, None
+	return first_key, first, first.end()
 
 def _remove_md_quotes(line):
 	rx = re.compile(r'^\s*>\s*')
@@ -257,24 +1207,24 @@ def _md_quote(line):
 	return line
 
 
+def _note_fields(lines):
+	"""
+	Citation fields of a note, None when missing
+	"""
+	fields = dict((key, None) for key in fields_dict)
+	for line in lines:
+		key, match, end = _parse_line(line, fields_dict)
+		if key is not None:
+			fields[key] = match.group('id')
+	return fields
+
 def _pandoc_citetext(zettel_id):
 	"""
 	Get reference for pandoc-style citation
 	"""
-	global fields_dict
-	citekey = None
-	loc = None
 	filepath, mtime = _z_get_filepath(zettel_id)
-
-	with open(filepath, 'r') as file_obj:
-		lines = file_obj.read().splitlines()
-
-	for line in lines:
-		key, match, end = _parse_line(line, fields_dict)
-		if key == "citekey":
-			citekey = match.group('id')
-		if key == "loc":
-			loc = match.group('id')
+	fields = _note_source(filepath).fields(filepath, mtime)
+	citekey, loc = fields['citekey'], fields['loc']
 
 	citetext = None
 	if (citekey and loc and loc != "0"):
@@ -295,100 +1245,153 @@ def _pandoc_cite_noauthor(zettel_id):
 	if citetext:
 		return "[-@" + citetext + "]" + _out_commented_id(zettel_id, pre=STR_SIGN_COMMENT)
 
-def parse_zettel(z_item, zettel_id):
+def _expand_fragment(fragment, data):
+	"""
+	Collect the output of a fragment into data.
+
+	A fragment is a generator yielding either output lines or a (fragment,
+	list) pair, for an inserted note whose output goes into the list (or in
+	place, if the list is None). Inserted notes are expanded with an explicit
+	stack, so that long chains of inserts don't hit the recursion limit.
+	"""
+	stack = [ (fragment, data) ]
+	while stack:
+		fragment, data = stack[-1]
+		for item in fragment:
+			if isinstance(item, str):
+				data.append(item)
+			else:
+				inserted, inserted_data = item
+				stack.append((inserted, data if inserted_data is None else inserted_data))
+				break
+		else:
+			stack.pop()
+
+def _with_source_title(fragment, z_item):
+	"""
+	Fragment adding a reference to the source after the last line of a text
+	"""
+	data = []
+	yield fragment, data
+	while (data[-1] == '\n'):
+		del data[-1]									# remove trailing lines
+	data[-1] = data[-1] + ' (' + (z_item.title or 'Untitled') + ')'		# add reference to last line in quote
+	for line in data:
+		yield line
+
+def _memoized_fragment(key, fragment):
+	"""
+	Fragment rendered only once in a run; it is replayed when inserted again,
+	unless note_cache evicted it in the meantime
+	"""
+	data = note_cache.get(key)
+	if data is None:
+		data = []
+		yield fragment, data
+		note_cache.put(key, data, sum(len(line) + 64 for line in data))
+	for line in data:
+		yield line
+
+def _zettel_fragment(z_item, zettel_id, frontmatter=None):
+	fragment = _zettel_lines(z_item, zettel_id, [] if frontmatter is None else frontmatter)
+	if (z_item.type == NT_RIGHT_TEXT) and not options['handout-mode']:
+		fragment = _with_source_title(fragment, z_item)
+	return fragment
+
+def _zettel_lines(z_item, zettel_id, frontmatter):
+	"""
+	Fragment for the contents of a note. Frontmatter lines are collected
+	into frontmatter
+	"""
 	global options, z_map, unindexed_links
 
-	filepath = z_item["path"]
+	filepath = z_item.path
 
 	yaml_divert = False
 	got_content = False
 	got_title = False
 	insert_sequence = []
-	data = []
-	frontmatter = []
-
-	def parse_chunk(chunk):
-		key, match, end = _parse_line(chunk, rx_dict)
-
-		if (key is None):
-			return chunk
-
-		left_chunk = chunk[:end]
-
-		if key == 'quote':
-			link = match.group('id')
-			insert_quotes.append(link)
-			left_chunk = rx_dict["quote"].sub("", left_chunk)
-
-		elif key == 'parallel_texts':
-			left_link, right_link = match.group('id_left'), match.group('id_right')
-			insert_parallel_texts.append((left_link, right_link))
-			left_chunk = rx_dict['parallel_texts'].sub("", left_chunk)
-
-		elif key == 'pandoc_cite':
-			link = match.group('id')
-			_z_add_to_stack(link, "citation")
-			left_chunk = rx_dict["pandoc_cite"].sub(_pandoc_cite(link), left_chunk)
-
-		elif key == 'pandoc_cite_inline':
-			link = match.group('id')
-			_z_add_to_stack(link, "citation")
-			left_chunk = rx_dict["pandoc_cite_inline"].sub(_pandoc_cite(link, parenthetical = False), left_chunk)
-
-		elif key == 'pandoc_cite_noauthor':
-			link = match.group('id')
-			_z_add_to_stack(link, "citation")
-			left_chunk = rx_dict["pandoc_cite_noauthor"].sub(_pandoc_cite_noauthor(link), left_chunk)
-
-		elif key == 'add_ref':
-			link = match.group('id')
-			insert_sequence.append(link)
-			left_chunk = rx_dict["add_ref"].sub("", left_chunk)
-
-		elif (key == 'link') or (options['link-all'] and (key == 'cross_ref')):
-			link = match.group('id')
-			if (link in z_map) and (z_map[link]["type"] in ['quote', 'left_text', 'right_text']):
-				left_chunk = rx_dict["link"].sub(_out_quoteref(z_map[link]["ref"], link), left_chunk) 
-			elif (z_item["type"] not in [ "citation" ]) and ((z_item["type"] == "index") or (options["only-link-from-index"] is not True)):
-				if (link not in z_map) and (z_item["type"] not in [ "index", "sequential" ]):
-					unindexed_links.append(link)
-				_z_add_to_stack(link, "body")
-				left_chunk = rx_dict[key].sub(_out_link(z_map[link]["ref"], link), left_chunk)
-			else:
-				left_chunk = rx_dict[key].sub(_out_commented_id(link), left_chunk)
 
-		elif key in [ 'cross_ref', 'cross_ref_alt' ]:
-			link = match.group('id')
-			left_chunk = rx_dict[key].sub(_out_commented_id(link, pre=STR_SIGN_COMMENT), left_chunk)
-
-		elif key == 'no_ref':
-			link = match.group('id')
-			left_chunk = rx_dict["no_ref"].sub(_out_commented_id(link), left_chunk)
+	def parse_chunk(chunk, tokens):
+		output = []
+		for key, match, end in tokens:
+			left_chunk = chunk[:end]
+
+			if key == 'quote':
+				link = match['id']
+				insert_quotes.append(link)
+				left_chunk = rx_dict["quote"].sub("", left_chunk)
+
+			elif key == 'parallel_texts':
+				left_link, right_link = match['id_left'], match['id_right']
+				insert_parallel_texts.append((left_link, right_link))
+				left_chunk = rx_dict['parallel_texts'].sub("", left_chunk)
+
+			elif key == 'pandoc_cite':
+				link = match['id']
+				_z_add_to_stack(link, NT_CITATION)
+				left_chunk = rx_dict["pandoc_cite"].sub(_pandoc_cite(link), left_chunk)
+
+			elif key == 'pandoc_cite_inline':
+				link = match['id']
+				_z_add_to_stack(link, NT_CITATION)
+				left_chunk = rx_dict["pandoc_cite_inline"].sub(_pandoc_cite(link, parenthetical = False), left_chunk)
+
+			elif key == 'pandoc_cite_noauthor':
+				link = match['id']
+				_z_add_to_stack(link, NT_CITATION)
+				left_chunk = rx_dict["pandoc_cite_noauthor"].sub(_pandoc_cite_noauthor(link), left_chunk)
+
+			elif key == 'add_ref':
+				link = match['id']
+				insert_sequence.append(link)
+				left_chunk = rx_dict["add_ref"].sub("", left_chunk)
+
+			elif (key == 'link') or (options['link-all'] and (key == 'cross_ref')):
+				link = match['id']
+				if (link in z_map) and (z_map[link].type & NT_TEXTS):
+					left_chunk = rx_dict["link"].sub(_out_quoteref(z_map[link].ref, link), left_chunk) 
+				elif (link not in z_map) and (link in external_notes):
+					left_chunk = rx_dict[key].sub(_out_external_link(link), left_chunk)
+				elif (z_item.type != NT_CITATION) and ((z_item.type == NT_INDEX) or (options["only-link-from-index"] is not True)):
+					if (link not in z_map) and not (z_item.type & (NT_INDEX | NT_SEQUENTIAL)):
+						unindexed_links.append(link)
+					_z_add_to_stack(link, NT_BODY)
+					left_chunk = rx_dict[key].sub(_out_link(z_map[link].ref, link), left_chunk)
+				else:
+					left_chunk = rx_dict[key].sub(_out_commented_id(link), left_chunk)
 
-		elif key == 'footnote':
-			fn_id = match.group('fn_id')
-			left_chunk = rx_dict['footnote'].sub("[^fn-" + zettel_id + "-" + fn_id + "]", left_chunk)
+			elif key in [ 'cross_ref', 'cross_ref_alt' ]:
+				link = match['id']
+				left_chunk = rx_dict[key].sub(_out_commented_id(link, pre=STR_SIGN_COMMENT), left_chunk)
 
+			elif key == 'no_ref':
+				link = match['id']
+				left_chunk = rx_dict["no_ref"].sub(_out_commented_id(link), left_chunk)
 
+			elif key == 'footnote':
+				fn_id = match['fn_id']
+				left_chunk = rx_dict['footnote'].sub("[^fn-" + zettel_id + "-" + fn_id + "]", left_chunk)
 
-		return left_chunk + parse_chunk(chunk[end:])
+			output.append(left_chunk)
+			chunk = chunk[end:]
 
-	with open(filepath, 'r') as file_object:
-		lines = file_object.read().splitlines()
+		output.append(chunk)
+		return ''.join(output)
 
 	zettel_title = 'Untitled'
-	for line in lines:
+	for line, tokens in _z_note_contents(filepath, z_item.mtime)[2]:
 		insert_quotes = []
 		insert_parallel_texts = []
 		insert_sequence = []
-		# at each line check for a match with a regex
-		key, match, end = _parse_line(line, rx_dict)
+		# each line was checked for a match with a regex when it was read
+		key, match, end = tokens[0] if tokens else (None, None, None)
 
 		if yaml_divert:
 			yaml_divert = not key in ["yaml_div", "yaml_end_div"]
 			if key == 'title':
-				zettel_title = match.group('id')
-				z_item['title'] = zettel_title
+				zettel_title = match['id']
+				z_item.title = zettel_title
 			frontmatter.append(line)
 			continue
 
@@ -404,78 +1407,81 @@ def parse_zettel(z_item, zettel_id):
 		# our paragraph heading after, not before it
 
 		if (key == "md_heading") and not got_content:
-			if (z_item["type"] != "quote" and ((not options['handout-mode']) or options['handout-with-sections'])): # headings in citation notes are ~~for handouts only~~ good for nothing
-				data.append(line)
-				data.append('')
+			if (z_item.type != NT_QUOTE and ((not options['handout-mode']) or options['handout-with-sections'])): # headings in citation notes are ~~for handouts only~~ good for nothing
+				yield line
+				yield ''
 				got_title = True
 			got_content = False
 			continue
 
 		if (not line == '') and not got_content:
 			if not got_title:
-				if not options['no-title'] and not z_item["type"] in ['quote', 'left_text', 'right_text']:  # insert note title as ATX heading unless it's a quote
-					data.append("## " + zettel_title)
+				if not options['no-title'] and not (z_item.type & NT_TEXTS):  # insert note title as ATX heading unless it's a quote
+					yield "## " + zettel_title
 				got_title = True
 			if (not options['handout-mode']):
-				if (z_item["type"] == "body"):
-					data.append(_out_paragraph_heading(z_item["ref"], zettel_id))
-				elif (z_item["type"] == "quote"):
-					data.append(_out_text_quote(z_item["ref"], zettel_id))
-				elif (z_item["type"] in [ 'sequential' ]):
-					data.append(_out_commented_id(zettel_id, pre=STR_SIGN_INSERT))
-			elif (z_item['type'] in ['quote']): # headings in handout before content
-					data.append(STR_HANDOUT_HEADING + ' ' + zettel_title)
-					data.append(_out_commented_id(zettel_id, pre=STR_SIGN_INSERT))
-			elif (z_item['type'] in ['left_text', 'right_text']) and not options['no-commented-references']:
-					data.append(_out_commented_id(zettel_id, pre=STR_SIGN_INSERT))
+				if (z_item.type == NT_BODY):
+					yield _out_paragraph_heading(z_item.ref, zettel_id)
+				elif (z_item.type == NT_QUOTE):
+					yield _out_text_quote(z_item.ref, zettel_id)
+				elif (z_item.type == NT_SEQUENTIAL):
+					yield _out_commented_id(zettel_id, pre=STR_SIGN_INSERT)
+			elif (z_item.type == NT_QUOTE): # headings in handout before content
+					yield STR_HANDOUT_HEADING + ' ' + zettel_title
+					yield _out_commented_id(zettel_id, pre=STR_SIGN_INSERT)
+			elif (z_item.type & (NT_LEFT_TEXT | NT_RIGHT_TEXT)) and not options['no-commented-references']:
+					yield _out_commented_id(zettel_id, pre=STR_SIGN_INSERT)
 			got_content = True
 
 		if got_content:
 			if options['handout-mode']:
 				if key == 'md_heading' and options['handout-with-sections']:
-					data.append('') # prepend a line for safety reasons
-					data.append(line)
-					data.append('')
+					yield '' # prepend a line for safety reasons
+					yield line
+					yield ''
 				else:
-					line = parse_chunk(line)
-					if z_item['type'] in ['left_text', 'right_text', 'quote']:
+					line = parse_chunk(line, tokens)
+					if z_item.type & NT_TEXTS:
 						line = _remove_md_quotes(line)
-						data.append(line)
+						yield line
 			else:
-				line = parse_chunk(line)
-				if (z_item['type'] in ['quote', 'left_text', 'right_text']): # enforce quotes when not printing handouts
+				line = parse_chunk(line, tokens)
+				if (z_item.type & NT_TEXTS): # enforce quotes when not printing handouts
 					line = _md_quote(line)
-				data.append(line)
-
-		if insert_sequence is not []:
-			for i in insert_sequence:
-				_z_add_to_stack(i, "sequential")
-				data = data + ['\n'] + parse_zettel(z_map[i], i)
-
-		if insert_quotes is not []:
-	   		for i in insert_quotes:
-	   			_z_add_to_stack(i, "quote")					# add to stack...
-	   			insert_data = parse_zettel(z_map[i], i)
-	   			data = data + ['\n'] + insert_data 			# ...but insert immediately after line
-
-		if insert_parallel_texts is not []:
-	   		for l, r in insert_parallel_texts:
-	   			_z_add_to_stack(l, 'left_text')
-	   			_z_add_to_stack(r, 'right_text')
-	   			insert_data = _out_parallel_texts(l, r)
-	   			data = data + ['\n'] + insert_data
-
-	if (z_item['type'] in ['right_text']) and not options['handout-mode']:
-		while (data[-1] == '\n'):
-			del data[-1]									# remove trailing lines
-		data[-1] = data[-1] + ' (' + zettel_title + ')'		# add reference to last line in quote
+				yield line
+
+		for i in insert_sequence:
+			_z_add_to_stack(i, NT_SEQUENTIAL)
+			yield '\n'
+			yield _zettel_fragment(z_map[i], i), None
+
+		for i in insert_quotes:
+			q_item = _z_add_to_stack(i, NT_QUOTE)			# add to stack...
+			yield '\n'
+			key = (i, q_item.type, q_item.ref, q_item.md5hash)
+			yield _memoized_fragment(key, _zettel_fragment(q_item, i)), None	# ...but insert immediately after line
+
+		for l, r in insert_parallel_texts:
+			l_item = _z_add_to_stack(l, NT_LEFT_TEXT)
+			r_item = _z_add_to_stack(r, NT_RIGHT_TEXT)
+			yield '\n'
+			key = (l, r, l_item.md5hash, r_item.md5hash)
+			yield _memoized_fragment(key, _out_parallel_texts(l, r)), None
+
+	if (z_item.type == NT_RIGHT_TEXT) and not options['handout-mode']:
+		pass	# the source is added by _with_source_title
 	elif options['insert-bib-ref']:
 		citetxt = _pandoc_citetext(zettel_id)
 		if citetxt:
-			data.append('')
-			data.append("@" + citetxt)
+			yield ''
+			yield "@" + citetxt
 
-	if z_item['type'] == 'index':
+def parse_zettel(z_item, zettel_id):
+	frontmatter = []
+	data = []
+	_expand_fragment(_zettel_fragment(z_item, zettel_id, frontmatter), data)
+
+	if z_item.type == NT_INDEX:
 		if options['suppress-index']:
 			if not options['no-front-matter']:
 				data = frontmatter
@@ -486,6 +1492,62 @@ def parse_zettel(z_item, zettel_id):
 
 	return data
 
+def _output_changed(destination, content, pathname=None):
+	"""
+	Check composed content against what was last written to a destination
+	"""
+	digest = hashlib.md5(content.encode('utf-8')).hexdigest()
+	previous = output_digests.get(destination)
+	if pathname and not os.path.isfile(pathname):
+		previous = None	# removed since
+	elif previous is None and pathname:
+		previous = _get_file_md5digest(pathname)
+	output_digests[destination] = digest
+	return digest != previous
+
+def _new_file_mode():
+	"""
+	Permissions of a new file, as set by the umask. The umask can only be
+	read by setting it, for the whole process: not to be called from threads
+	"""
+	umask = os.umask(0)
+	os.umask(umask)
+	return 0o666 & ~umask
+
+def _write_atomically(pathname, content, new_mode=None):
+	"""
+	Replace a file in a single step, so that readers never see it half-written.
+	A symlink is followed, to replace the file it points to. Anything but a
+	regular file (/dev/null, a FIFO...) or a file in a directory that can't be
+	written to is written in place instead. A new file gets new_mode, which
+	must be given when writing from a thread (see _new_file_mode)
+	"""
+	import tempfile, stat
+
+	target = os.path.realpath(pathname)
+	directory, base = os.path.split(target)
+	try:
+		st = os.stat(pathname)
+	except FileNotFoundError:
+		st = None
+	if ((st is not None) and not stat.S_ISREG(st.st_mode)) or not os.access(directory, os.W_OK | os.X_OK):
+		with open(pathname, 'wb' if isinstance(content, bytes) else 'w') as f:
+			f.write(content)
+		return
+	if st is not None:
+		mode = st.st_mode & 0o777
+	else:
+		mode = _new_file_mode() if new_mode is None else new_mode
+	fd, tmp_pathname = tempfile.mkstemp(dir=directory, prefix='.' + base + '.')
+	try:
+		with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as f:
+			f.write(content)
+		os.chmod(tmp_pathname, mode)
+		os.replace(tmp_pathname, target)
+	except:
+		os.unlink(tmp_pathname)
+		raise
+
 def stream_to_marked(data):
 	from AppKit import NSPasteboard
 
@@ -499,28 +1561,152 @@ def stream_to_marked(data):
 def get_first_modified():
 	global z_stack
 	global z_map
+	global z_index_fresh
+	z_index_fresh = False
+	for source in set(note_sources.values()):
+		source.refresh()
 	c = 0
 	result = None
 	while (not result and c < len(z_stack)):
 		cur_path, cur_mtime = _z_get_filepath(z_stack[c])
-		if cur_mtime != z_map[z_stack[c]]["mtime"]:
-			md5hash = _get_file_md5digest(cur_path)
-			if md5hash != z_map[z_stack[c]]["md5hash"]:
+		if cur_mtime != z_map[z_stack[c]].mtime:
+			md5hash = _z_note_contents(cur_path, cur_mtime)[1]
+			if md5hash != z_map[z_stack[c]].md5hash:
 				result = c
-		z_map[z_stack[c]]["path"], z_map[z_stack[c]]["mtime"] = cur_path, cur_mtime # update modified filenames and mtimes
+		z_map[z_stack[c]].path, z_map[z_stack[c]].mtime = cur_path, cur_mtime # update modified filenames and mtimes
 		c += 1
 	return result
 
+def _z_select(written, only):
+	"""
+	Ids of the notes selected for rendering: a note id, a range of ids
+	(`first..last`) or the text of a heading opening a note, in which case
+	the selection runs until the next note opening with a heading of the same
+	or higher level
+	"""
+	if '..' in only:
+		first, last = only.split('..', 1)
+		if not (first and last):
+			raise ValueError("--only: a range takes a first and a last note id (first..last)")
+	elif only in written:
+		first, last = only, only
+	else:
+		first, last = None, None
+		for zn in written:
+			if first is None:
+				for line in z_headings.get(zn, []):
+					if line.lstrip('#').strip().lower() == only.strip().lower():
+						first, last, level = zn, zn, _heading_level(line)
+						break
+			elif zn in z_headings and _heading_level(z_headings[zn][0]) <= level:
+				break
+			else:
+				last = zn
+		if first is None:
+			raise ValueError("--only: no note opening with heading '" + only + "'")
+
+	for zn in [ first, last ]:
+		if zn not in written:
+			raise ValueError("--only: note " + zn + " is not in the output")
+	if written.index(first) > written.index(last):
+		raise ValueError("--only: note " + last + " comes before " + first + " in the output")
+	return set(written[written.index(first):written.index(last) + 1])
+
+def _init_worker(state):
+	global options, z_map, z_index, external_notes, index_filename, zettel_dir, CF_PANDOC
+	options, z_map, z_index, external_notes, index_filename, zettel_dir, CF_PANDOC = state
+	note_sources.clear() # archives are opened again, not to share file offsets with the parent
+	note_cache.budget = options['cache-size']
+
+def _render_zettel(zettel_id):
+	return parse_zettel(z_map[zettel_id], zettel_id) + ['']
+
+def _render_in_parallel(zettel_ids):
+	"""
+	Render notes on a pool of processes, yielding their output in order.
+	Numbering must have been fixed before (see LinkWalk)
+	"""
+	import multiprocessing
+
+	state = (options, z_map, z_index, external_notes, index_filename, zettel_dir, CF_PANDOC)
+	chunksize = max(1, len(zettel_ids) // (options['jobs'] * 16))
+	with multiprocessing.Pool(options['jobs'], _init_worker, (state,)) as pool:
+		for d in pool.imap(_render_zettel, zettel_ids, chunksize):
+			yield d
+
+NUMBERING_VERSION = 1
+
+def _numbering_map():
+	"""
+	Type, number and anchor of every note in the manuscript, for
+	--write-numbering
+	"""
+	notes = OrderedDict()
+	for zettel_id, z_item in z_map.items():
+		anchor = None
+		if (z_item.type == NT_BODY) and options['heading-identifier'] and not options['no-paragraph-headings']:
+			anchor = options['heading-identifier'] + str(z_item.ref)
+		notes[zettel_id] = OrderedDict([ ('type', NT_NAMES[z_item.type]), ('ref', z_item.ref), ('anchor', anchor) ])
+	return OrderedDict([ ('version', NUMBERING_VERSION), ('title', z_map['index'].title),
+		('output', options['output']), ('notes', notes) ])
+
+def write_numbering(pathname):
+	import json
+
+	content = json.dumps(_numbering_map(), indent=1, ensure_ascii=False) + '\n'
+	if _output_changed(pathname, content, pathname):
+		_write_atomically(pathname, content)
+
+def _read_external_numbering():
+	"""
+	Read the maps given with --external-numbering. A note numbered in more
+	than one of them is linked to the first
+	"""
+	import json
+
+	notes = {}
+	for pathname in options['external-numbering']:
+		with open(pathname, encoding='utf-8') as f:
+			numbering = json.load(f)
+		if numbering.get('version') != NUMBERING_VERSION:
+			raise ValueError(pathname + " is not a numbering map written by this version of zettel-compose.py")
+		for zettel_id, entry in numbering['notes'].items():
+			if (zettel_id != 'index') and (zettel_id not in notes):
+				notes[zettel_id] = (numbering['title'], entry)
+	return notes
+
 def parse_index(pathname):
-	global z_stack, z_map, options, unindexed_links
+	global z_stack, z_map, options, unindexed_links, external_notes
 
 	c = 0
 	parse_index.output = [ ] # [ STR_STREAMING_ID ] not working?
 
 	parse_index.f_out = None
 
-	def write_to_output(contents, zn=None):
-		if not options['no-separator']:
+	if options['renumber-footnotes'] and not options['extract-mode']:
+		footnotes = FootnoteStage(at_chapter_end=(options['renumber-footnotes'] == 'chapter'))
+	else:
+		footnotes = None
+
+	def starts_chapter(zn, contents):
+		if options['split-on'] == 'index':
+			if sections.get(zn, 0) > write_to_output.section:
+				write_to_output.section = sections[zn]
+				return True
+			return False
+		heading = next((line for line in contents if line.strip()), '')
+		return bool(rx_dict['md_heading'].match(heading)) and (_heading_level(heading) <= options['split-on'])
+
+	def write_to_output(contents, zn=None, separator=True):
+		if chapters and (zn not in [ None, 'index' ]):
+			if starts_chapter(zn, contents):
+				if footnotes and footnotes.at_chapter_end:
+					write_to_output(footnotes.flush(), separator=False) # keep notes in their chapter's file
+				chapters.start()
+			chapters.chapters[-1]['notes'].append(zn)
+		if footnotes and (zn is not None):
+			contents = footnotes.process(contents)
+		if separator and not options['no-separator']:
 			contents = contents + SEPARATOR
 		if parse_index.f_out:
 			if options['extract-mode']:
@@ -532,31 +1718,375 @@ def parse_index(pathname):
 		if options["stream-to-marked"]:
 			parse_index.output = parse_index.output + contents
 
+	external_notes = _read_external_numbering()
 	_z_set_index(pathname)
 
-	if options["output"] and (options["output"] != '-'):
-		parse_index.f_out = open(options["output"], "w")
+	if options['only'] or (options['jobs'] > 1):
+		written = LinkWalk().walk(z_stack)
+	if options['only']:
+		selection = _z_select(written, options['only'])
+	else:
+		selection = None
+
+	chapters = None
+	if options['split-on']:
+		if (not options['output']) or (options['output'] == '-'):
+			raise ValueError("--split-on needs an output file name (-O)")
+		if options['split-on'] == 'index':
+			sections = _index_sections(pathname)
+			write_to_output.section = 0
+		parse_index.f_out = chapters = ChapterWriter(options['output'])
+	elif options["output"] and (options["output"] != '-'):
+		parse_index.f_out = io.StringIO()	# written at once when done
 	elif not options["stream-to-marked"]:
 		parse_index.f_out = sys.stdout
 
+	if options['jobs'] > 1:
+		zettel_ids = [ zn for zn in written if (selection is None) or (zn in selection) ]
+		for zn, d in zip(zettel_ids, _render_in_parallel(zettel_ids)):
+			if options["verbose"]:
+				print ("zettel id " + zn)
+			write_to_output(d, zn)
+		c = len(z_stack)
+
 	while len(z_stack) > c:
 		if options["verbose"]:
 			print ("zettel id " + z_stack[c])
-		if z_map[z_stack[c]]['type'] not in [ 'quote', 'citation', 'left_text', 'right_text' ]:
+		if selection is not None and z_stack[c] not in selection:
+			pass
+		elif not (z_map[z_stack[c]].type & (NT_TEXTS | NT_CITATION)):
 			d = parse_zettel(z_map[z_stack[c]], z_stack[c]) + ['']
-			if (z_map[z_stack[c]]["type"] not in [ "sequential" ]):
+			if (z_map[z_stack[c]].type != NT_SEQUENTIAL):
 				write_to_output(d, z_stack[c])
 		c += 1
 
-	if unindexed_links and not options['extract-mode']:
+	if unindexed_links and not options['extract-mode'] and selection is None:
 		d = _out_unindexed_notes()
 		write_to_output(d)
 
-	if parse_index.f_out and (parse_index.f_out is not sys.stdout):
-		parse_index.f_out.close()
+	if footnotes:
+		write_to_output(footnotes.flush(), separator=False)
+
+	if chapters:
+		chapters.finish()
+	elif parse_index.f_out and (parse_index.f_out is not sys.stdout):
+		content = parse_index.f_out.getvalue()
+		if _output_changed(options["output"], content, options["output"]):
+			_write_atomically(options["output"], content)
+		elif options["verbose"]:
+			print("Output unchanged")
 
 	if options["stream-to-marked"]:
-		stream_to_marked("\n".join(parse_index.output))
+		content = "\n".join(parse_index.output)
+		if _output_changed('marked', content):
+			stream_to_marked(content)
+		elif options["verbose"]:
+			print("Preview unchanged")
+
+	if options['write-numbering']:
+		write_numbering(options['write-numbering'])
+
+LINK_KEYS = [ 'pandoc_cite_noauthor', 'pandoc_cite_inline', 'pandoc_cite', 'no_ref', 'quote', 'add_ref', 'link', 'cross_ref_alt', 'cross_ref' ]
+
+class LinkWalk(object):
+	"""
+	Walk the notes reachable from the index through the tokens of their
+	lines, registering the notes they link to and insert as composition
+	would, in the same order, but without rendering anything. Notes are
+	registered in z_map and z_stack (numbering them); subclasses may
+	register them elsewhere
+	"""
+	def registered(self, zettel_id):
+		"""
+		Type of a registered note, None if not registered yet
+		"""
+		return z_map[zettel_id].type if zettel_id in z_map else None
+
+	def register(self, zettel_id, z_type):
+		_z_add_to_stack(zettel_id, z_type)
+
+	def lines(self, zettel_id):
+		return _z_note_contents(z_map[zettel_id].path, z_map[zettel_id].mtime)[2]
+
+	def exists(self, zettel_id, source):
+		return True
+
+	def unindexed(self, zettel_id, source):
+		unindexed_links.append(zettel_id)
+
+	def title(self, zettel_id, title):
+		z_map[zettel_id].title = title
+
+	def heading(self, zettel_id, line):
+		z_headings.setdefault(zettel_id, []).append(line)
+
+	def walk(self, stack):
+		"""
+		Walk every note in stack, which grows as notes are registered. Notes
+		inserted in others are walked where they are inserted, and every note
+		only once. Returns the ids of the notes to be written, in order
+		"""
+		written, walked = [], set()
+		c = 0
+		while c < len(stack):
+			zn = stack[c]
+			c += 1
+			if self.registered(zn) & (NT_TEXTS | NT_CITATION | NT_SEQUENTIAL):
+				continue
+			written.append(zn)
+			if zn in walked:
+				continue
+			walked.add(zn)
+			notes = [ self.note(zn) ]
+			while notes:
+				for inserted in notes[-1]:
+					if inserted not in walked:
+						walked.add(inserted)
+						notes.append(self.note(inserted))
+						break
+				else:
+					notes.pop()
+		return written
+
+	def note(self, zettel_id):
+		"""
+		Register what a note links to, line by line, yielding the notes it
+		inserts after each line, each to be walked before going on
+		"""
+		z_type = self.registered(zettel_id)
+		in_yaml, got_content = False, False
+		for line, tokens in self.lines(zettel_id):
+			if not tokens:	# most lines
+				got_content = got_content or (line != '' and not in_yaml)
+				continue
+			key = tokens[0][0]
+			if in_yaml:
+				in_yaml = key not in [ 'yaml_div', 'yaml_end_div' ]
+				if key == 'title':
+					self.title(zettel_id, tokens[0][1]['id'])
+				continue
+			if key == 'yaml_div':
+				in_yaml = True
+				continue
+			if key == 'ignore':
+				continue
+			if (key == 'md_heading') and not got_content:
+				self.heading(zettel_id, line)
+				continue
+			got_content = got_content or (line != '')
+			if not got_content:
+				continue
+			if options['handout-mode'] and options['handout-with-sections'] and (key == 'md_heading'):
+				continue	# printed as is
+
+			sequence, quotes, texts = [], [], []
+			for key, match, end in tokens:
+				if key == 'parallel_texts':
+					pair = [ (match['id_left'], NT_LEFT_TEXT), (match['id_right'], NT_RIGHT_TEXT) ]
+					texts.append([ (link, t) for link, t in pair if self.exists(link, zettel_id) ])
+					continue
+				if key not in LINK_KEYS:
+					continue
+				link = match['id']
+				link_type = self.registered(link)
+				linking = (key == 'link') or (options['link-all'] and (key == 'cross_ref'))
+				if linking and (link_type is not None) and (link_type & NT_TEXTS):
+					continue	# a reference to a text
+				if linking and (link_type is None) and (link in external_notes):
+					continue	# numbered in another manuscript
+				if not self.exists(link, zettel_id):
+					continue
+				if key == 'quote':
+					quotes.append([ (link, NT_QUOTE) ])
+				elif key == 'add_ref':
+					sequence.append([ (link, NT_SEQUENTIAL) ])
+				elif link_type is not None:
+					pass	# registered already
+				elif key.startswith('pandoc_cite'):
+					self.register(link, NT_CITATION)
+				elif linking and (z_type != NT_CITATION) and ((z_type == NT_INDEX) or not options['only-link-from-index']):
+					if not (z_type & (NT_INDEX | NT_SEQUENTIAL)):
+						self.unindexed(link, zettel_id)
+					self.register(link, NT_BODY)
+
+			for inserts in sequence + quotes + texts:	# in the order composition inserts them
+				for link, t in inserts:
+					self.register(link, t)
+				for link, t in inserts:
+					yield link
+
+class LinkCheck(LinkWalk):
+	"""
+	The walk of --check: notes are registered apart from z_map, and links to
+	missing notes and § links to notes not in the index are collected
+	"""
+	def __init__(self, index_pathname, files):
+		self.index_pathname = index_pathname
+		self.files = files
+		self.seen = OrderedDict([ ('index', NT_INDEX) ])
+		self.stack = [ 'index' ]
+		self.dangling, self.orphans = [], []
+
+	def registered(self, zettel_id):
+		return self.seen.get(zettel_id)
+
+	def register(self, zettel_id, z_type):
+		if zettel_id not in self.seen:
+			self.seen[zettel_id] = z_type
+			self.stack.append(zettel_id)
+
+	def lines(self, zettel_id):
+		pathname = self.index_pathname if zettel_id == 'index' else self.files[zettel_id][0]
+		return _z_note_contents(pathname, _note_source(pathname).mtime(pathname), digest=False)[2]
+
+	def exists(self, zettel_id, source):
+		if zettel_id not in self.files:
+			self.dangling.append((zettel_id, source))
+			return False
+		return True
+
+	def unindexed(self, zettel_id, source):
+		self.orphans.append((zettel_id, source))
+
+	def title(self, zettel_id, title):
+		pass
+
+	def heading(self, zettel_id, line):
+		pass
+
+def check_links(index_pathnames):
+	"""
+	Walk the notes reachable from each index note, reporting dangling
+	references, § targets missing from the index (which would be printed
+	as unindexed notes) and ids with more than one file. Nothing is
+	rendered. Returns the number of problems found
+	"""
+	global external_notes
+
+	scanned = {}
+	problems = 0
+	external_notes = _read_external_numbering()
+
+	for index_pathname in index_pathnames:
+		roots = tuple(_search_roots(index_pathname))
+		if roots not in scanned:
+			scanned[roots] = _scan_notes(roots)
+		files = scanned[roots]
+
+		check = LinkCheck(index_pathname, files)
+		check.walk(check.stack)
+
+		print(index_pathname + ": " + str(len(check.seen)) + " notes")
+		for link, source in check.dangling:
+			print("  dangling reference [[" + link + "]] in " + source)
+		for link, source in check.orphans:
+			print("  not in the index: § [[" + link + "]] in " + source)
+		for zn in check.seen:
+			if zn != 'index' and len(files[zn]) > 1:
+				print("  duplicate id " + zn + ": " + ", ".join(files[zn]))
+				problems += 1
+		problems += len(check.dangling) + len(check.orphans)
+	return problems
+
+def compose():
+	"""
+	Compose the index note into the output, or into each of the targets.
+	Notes are read and tokenized only once for all targets
+	"""
+	global z_stack, z_map, options, path_cache, z_index_fresh, composed
+
+	composed = False
+	path_cache = {}
+	z_index_fresh = False
+	if not options['targets']:
+		_initialize_stack()
+		parse_index(index_filename)
+	else:
+		shared_options = options
+		watched = OrderedDict()
+		for output, args in shared_options['targets']:
+			options = dict(shared_options)
+			parse_options(shlex.split(args))
+			options['output'], options['targets'] = output, None
+			_initialize_stack()
+			parse_index(index_filename)
+			for zn in z_stack:
+				watched.setdefault(zn, z_map[zn])
+		options = shared_options
+		z_stack, z_map = list(watched), dict(watched) # watch the notes of every target
+	path_cache = None
+	composed = True
+	if options['verbose']:
+		print('Cache: ' + note_cache.report())
+
+def _state_options():
+	return dict((k, v) for k, v in options.items() if k not in STATE_IGNORED_OPTIONS)
+
+def save_state(pathname):
+	"""
+	Save notes read so far, numbering and output hashes
+	"""
+	import pickle
+
+	paths = set(z_map[zn].path for zn in z_stack)
+	state = {
+		'version': STATE_VERSION,
+		'index': os.path.abspath(index_filename),
+		'options': _state_options(),
+		'z_stack': z_stack,
+		'z_map': z_map,
+		'output_digests': output_digests,
+		'external_numbering': [ _get_file_md5digest(f) for f in options['external-numbering'] ],
+		'note_cache': dict((k, v) for k, v in note_cache.items() if k in paths)
+	}
+	_write_atomically(pathname, pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+def load_state(pathname):
+	"""
+	Restore a saved state. Notes read before are only read again if their
+	mtime changed; numbering and output hashes are restored only when the
+	index, options and --external-numbering maps are the same. Returns True
+	if they were
+	"""
+	global z_stack, z_map
+	import pickle
+
+	try:
+		with open(pathname, 'rb') as f:
+			state = pickle.load(f)
+		if state['version'] != STATE_VERSION:
+			return False
+	except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+		return False
+
+	for pathname, cached in state['note_cache'].items():
+		note_cache.put(pathname, cached, _note_size(cached))
+	if (state['index'] != os.path.abspath(index_filename)) or (state['options'] != _state_options()):
+		return False
+	if state.get('external_numbering') != [ _get_file_md5digest(f) for f in options['external-numbering'] ]:
+		return False
+	z_stack, z_map = state['z_stack'], state['z_map']
+	output_digests.update((k, v) for k, v in state['output_digests'].items() if k != 'marked')
+	return True
+
+def _outputs_current():
+	"""
+	Check that every output is a file holding what was last composed
+	"""
+	if options['stream-to-marked']:
+		return False
+	outputs = [ output for output, args in options['targets'] ] if options['targets'] else [ options['output'] ]
+	if options['write-numbering']:
+		outputs.append(options['write-numbering'])
+	if options['split-on'] and not options['targets']:
+		manifest = _manifest_name(options['output'])
+		outputs[0:1] = [ manifest ] + (_manifest_files(manifest) or [ None ])
+	for output in outputs:
+		if (not output) or (output == '-') or not os.path.isfile(output):
+			return False
+		if output_digests.get(output) != _get_file_md5digest(output):
+			return False
+	return True
 
 def watch_folder():
 	global z_stack, options
@@ -567,80 +2097,170 @@ def watch_folder():
 			if options["verbose"]:
 				print("note " + str(modified) + " id " + z_stack[modified] + " was modified")
 			time.sleep(1)
-			_initialize_stack()
-			parse_index(index_filename)
+			while get_first_modified() is not None: # wait for a burst of changes to settle
+				time.sleep(1)
+			compose()
+			if options['state-file']:
+				save_state(options['state-file'])
 		time.sleep(options["sleep-time"])
 
-useroptions, infile = getopt.getopt(sys.argv[1:], 'CO:MH:s:WnSIt:G:vh:PLX', [ 'no-commented-references', 
-	'no-paragraph-headings', 'heading-identifier=', 'watch', 'sleep-time=', 'output=', 'stream-to-marked', 
-	'suppress-index', 'no-separator', 'link-all', 'custom-url=', 'section-symbol=', 'no-title', 'insert-bib-ref',
-	'no-front-matter'])
-
-if infile == [ ]:
-	raise ValueError("Argument is missing: you must provide a file name for the index note.")
-
-_initialize_stack()
-
-for opt, arg in useroptions:
-	if opt in ('-O', '--output='):
-		options["output"] = arg
-	elif opt in ('-M', '--stream-to-marked'):
-		options["stream-to-marked"] = True
-	elif opt in ('-H', '--heading-identifier='):
-		options["heading-identifier"] = arg
-	elif opt in ('-W', '--watch'):
-		options["watch"] = True
-	elif opt in ('-s', '--sleep-time='):
-		options["sleep-time"] = arg
-	elif opt in ('-n', '--no-paragraph-headings'):
-		options["no-paragraph-headings"] = True
-	elif opt in ('--no-separator'):
-		options["no-separator"] = True
-	elif opt in ('-C', '--no-commented-references'):
-		options['no-commented-references'] = True
-	elif opt in ('-S', '--suppress-index'):
-		options["suppress-index"] = True
-	elif opt in ('-I'):
-		options["only-link-from-index"] = True
-	elif opt in ('-t'):
-		z_count["quote"] = (int(arg) - 1)
-	elif opt in ('-G'):
-		if ('l' not in arg) and ('r' not in arg):
-			raise ValueError("-G should take either 'l' or 'r' as argument")
-		options['parallel-texts-selection'] = arg
-	elif opt in ('-v'):
-		options["verbose"] = True
-	elif opt in ('-h'):
-		options['handout-mode'] = True
-		options['handout-with-sections'] = ('+' in arg)
-	elif opt in ('-P'):
-		options['parallel-texts-processor'] = True
-		options['no-commented-references'] = True
-	elif opt in ('-L', '--link-all'):
-		options['link-all'] = True
-	elif opt in ('--custom-url='):
-		options['custom-url'] = arg
-	elif opt in ('--section-symbol='):
-		options['section-symbol'] = arg
-	elif opt in ('--no-title'):
-		options['no-title'] = True
-	elif opt in ('--insert-bib-ref'):
-		options['insert-bib-ref'] = True
-	elif opt in ('--no-front-matter'):
-		options['no-front-matter'] = True
-	elif opt in ('-X'):
-		options['extract-mode'] = True
-
-index_filename = infile[0]
-if options["verbose"]:
-	print("Processing file " + infile[0])
-
-zettel_dir = os.path.dirname(index_filename)
-
-parse_index(index_filename)
-
-if options["watch"]:
+def _parse_targets(spec):
+	"""
+	Targets are given as `output[=options]`, separated by semicolons
+	"""
+	targets = []
+	for target in spec.split(';'):
+		output, _, args = target.partition('=')
+		if output.strip():
+			targets.append((output.strip(), args))
+	return targets
+
+def _parse_size(arg):
+	"""
+	A number of bytes, optionally followed by K, M or G
+	"""
+	units = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3 }
+	arg = arg.strip().upper()
+	if arg[-1:] in units:
+		return int(float(arg[:-1]) * units[arg[-1]])
+	return int(arg)
+
+def parse_options(argv):
+	"""
+	Set options from the command line, returning the remaining arguments
+	"""
+	useroptions, infile = getopt.getopt(argv, 'CO:MH:s:WnSIt:G:vh:PLXj:R', [ 'no-commented-references', 
+		'no-paragraph-headings', 'heading-identifier=', 'watch', 'sleep-time=', 'output=', 'stream-to-marked', 
+		'suppress-index', 'no-separator', 'link-all', 'custom-url=', 'section-symbol=', 'no-title', 'insert-bib-ref',
+		'no-front-matter', 'renumber-footnotes=', 'only=',
+		'jobs=', 'targets=', 'check', 'state-file=', 'notes-dir=', 'recursive', 'cache-size=', 'sync=',
+		'write-numbering=', 'external-numbering=', 'split-on=', 'rev='])
+
+	for opt, arg in useroptions:
+		if opt in ('-O', '--output='):
+			options["output"] = arg
+		elif opt in ('-M', '--stream-to-marked'):
+			options["stream-to-marked"] = True
+		elif opt in ('-H', '--heading-identifier='):
+			options["heading-identifier"] = arg
+		elif opt in ('-W', '--watch'):
+			options["watch"] = True
+		elif opt in ('-s', '--sleep-time='):
+			options["sleep-time"] = arg
+		elif opt in ('-n', '--no-paragraph-headings'):
+			options["no-paragraph-headings"] = True
+		elif opt in ('--no-separator'):
+			options["no-separator"] = True
+		elif opt in ('-C', '--no-commented-references'):
+			options['no-commented-references'] = True
+		elif opt in ('-S', '--suppress-index'):
+			options["suppress-index"] = True
+		elif opt in ('-I'):
+			options["only-link-from-index"] = True
+		elif opt in ('-t'):
+			options['first-text'] = int(arg)
+		elif opt in ('-G'):
+			if ('l' not in arg) and ('r' not in arg):
+				raise ValueError("-G should take either 'l' or 'r' as argument")
+			options['parallel-texts-selection'] = arg
+		elif opt in ('-v'):
+			options["verbose"] = True
+		elif opt in ('-h'):
+			options['handout-mode'] = True
+			options['handout-with-sections'] = ('+' in arg)
+		elif opt in ('-P'):
+			options['parallel-texts-processor'] = True
+			options['no-commented-references'] = True
+		elif opt in ('-L', '--link-all'):
+			options['link-all'] = True
+		elif opt in ('--custom-url='):
+			options['custom-url'] = arg
+		elif opt in ('--section-symbol='):
+			options['section-symbol'] = arg
+		elif opt in ('--no-title'):
+			options['no-title'] = True
+		elif opt in ('--insert-bib-ref'):
+			options['insert-bib-ref'] = True
+		elif opt in ('--no-front-matter'):
+			options['no-front-matter'] = True
+		elif opt in ('-X'):
+			options['extract-mode'] = True
+		elif opt in ('--renumber-footnotes'):
+			if arg not in ('note', 'chapter'):
+				raise ValueError("--renumber-footnotes should take either 'note' or 'chapter' as argument")
+			options['renumber-footnotes'] = arg
+		elif opt in ('--only'):
+			options['only'] = arg
+		elif opt in ('-j', '--jobs'):
+			options['jobs'] = int(arg)
+		elif opt in ('--notes-dir'):
+			options['notes-dirs'] = options['notes-dirs'] + [ arg ]
+		elif opt in ('-R', '--recursive'):
+			options['recursive'] = True
+		elif opt in ('--cache-size'):
+			options['cache-size'] = _parse_size(arg)
+		elif opt in ('--state-file'):
+			options['state-file'] = arg
+		elif opt in ('--check'):
+			options['check'] = True
+		elif opt in ('--sync'):
+			options['sync'] = arg
+		elif opt in ('--split-on'):
+			if (arg != 'index') and (arg not in [ '1', '2', '3', '4' ]):
+				raise ValueError("--split-on should take either 'index' or a heading level (1 to 4) as argument")
+			options['split-on'] = arg if arg == 'index' else int(arg)
+		elif opt in ('--rev'):
+			options['rev'] = arg
+		elif opt in ('--write-numbering'):
+			options['write-numbering'] = arg
+		elif opt in ('--external-numbering'):
+			options['external-numbering'] = options['external-numbering'] + [ arg ]
+		elif opt in ('--targets'):
+			options['targets'] = _parse_targets(arg)
+
+	return infile
+
+def main(argv):
+	global index_filename, zettel_dir
+
+	infile = parse_options(argv)
+	note_cache.budget = options['cache-size']
+
+	if infile == [ ]:
+		raise ValueError("Argument is missing: you must provide a file name for the index note.")
+
+	if options['check']:
+		sys.exit(1 if check_links(infile) else 0)
+
+	if options['sync']:
+		sync_store(options['sync'], infile)
+		return
+
+	index_filename = infile[0]
 	if options["verbose"]:
-		print("Will now watch for changes")
-	watch_folder()
+		print("Processing file " + infile[0])
+
+	zettel_dir = os.path.dirname(index_filename)
+
+	if options['state-file'] and load_state(options['state-file']) \
+			and (get_first_modified() is None) and _outputs_current():
+		if options["verbose"]:
+			print("No changes since the state was saved")
+	else:
+		compose()
+		if options['state-file']:
+			save_state(options['state-file'])
 
+	if options["watch"]:
+		if options["verbose"]:
+			print("Will now watch for changes")
+		if options['state-file']:
+			signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+		try:
+			watch_folder()
+		finally:
+			if options['state-file'] and composed: # not halfway through a composition
+				save_state(options['state-file'])
+
+if __name__ == '__main__':
+	main(sys.argv[1:])